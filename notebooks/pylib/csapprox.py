@@ -1,6 +1,18 @@
+import numba as nb
 import numpy as np
+import pandas as pd
+import time
+import inspect
 from scipy.integrate import quad
-from typing import Union, List
+from iminuit import Minuit
+from iminuit.cost import LeastSquares
+from typing import Union, List, Tuple
+
+# имена параметров `MDVM.Cross_Section` (порядок как в par)
+MDVM_PARAMETERS = ['n', 'r1', 'r2', 'r3', 'p1', 'p2', 'mr3', 'wr3', 'mo2', 'wo2', 'mp1', 'wp1', 'mo3', 'wo3', 
+                   'mr1', 'wr1', 'mo1', 'wo1', 'mp2', 'wp2', 'a20', 'a21', 'a22', 'a23']
+# массы и ширины, которые обычно фиксируются в фите сечения
+MDVM_FIXED = ['mr3', 'wr3', 'mo2', 'wo2', 'mp1', 'wp1', 'mo3', 'wo3', 'mr1', 'wr1', 'mo1', 'wo1', 'mp2', 'wp2']
 
 class MDVM():
     """
@@ -55,6 +67,39 @@ class MDVM():
         self.w0Phi = 4.247
         self.w0Rho = 149.1
         self.w0Omg = 8.49
+        
+        self._bw_cache = {}
+    
+    def constants(self) -> np.array:
+        """
+        Массы, ширины и константы в порядке, который ожидает `mdvm_cross_section`
+        """
+        
+        return np.array([self.mRho, self.mOmg, self.mPhi, self.mK0, self.mP0, self.mKC, self.mPC, self.mKstar, 
+                         self.w0Rho, self.w0Omg, self.w0Phi, self.ALPHA, self.C])
+    
+    def Cross_Section_Compiled(self, x: np.array, par: List[float], charged: bool = False) -> np.array:
+        """
+        То же, что `Cross_Section`, но скомпилированным numba ядром `mdvm_cross_section` (за один проход, без промежуточных массивов)
+        
+        Parameters
+        ----------
+        x : numpy.array
+            набор s, в которых нужно вернуть сечение, GeV^2
+        par : List[float]
+            список параметров для вычисления формфактора
+        charged : bool
+            сечение в заряженные (True) или нейтральные (False) каоны нужно вернуть (default is False)
+            
+        Returns
+        -------
+        cs : numpy.array
+            сечение в точках x
+        """
+        
+        x = np.asarray(x, dtype=np.float64)
+        cs = mdvm_cross_section(np.ascontiguousarray(x.ravel()), np.asarray(par, dtype=np.float64), charged, self.constants())
+        return cs.reshape(x.shape)
     
     def BETA(self, s: np.array, M_K: float) -> np.array:
         """
@@ -269,6 +314,25 @@ class MDVM():
         return self.BW(s, m, g, self.WPhi1680)#self.BW_PhiX(s, mPhi2, gPhi2)#BESIII:2239.2, 139.8 #PDG: 2198, 71 
     
     #PUBLIC
+    def fixed_bw(self, x: np.array) -> Tuple[np.array, np.array, np.array]:
+        """
+        BW_Rho, BW_Omg и BW_Phi (с фазовыми объёмами в ширинах) в точках x, GeV
+        
+        Массы и ширины этих резонансов фиксированы, поэтому для одного набора энергий во время фита 
+        значения не меняются: они кэшируются по содержимому x и всем числовым атрибутам модели 
+        (массы, ширины и константы, в том числе массы продуктов распада в энергозависимых ширинах)
+        """
+        
+        x = np.asarray(x, dtype=np.float64)
+        constants = tuple(sorted((k, v) for k, v in vars(self).items() if isinstance(v, (int, float))))
+        key = (x.shape, x.tobytes(), constants)
+        if key not in self._bw_cache:
+            if len(self._bw_cache) >= 32:
+                self._bw_cache.pop(next(iter(self._bw_cache)))
+            s = (x*1e3)**2
+            self._bw_cache[key] = (self.BW_Rho(s), self.BW_Omg(s), self.BW_Phi(s))
+        return self._bw_cache[key]
+    
     def F0(self, x, KR, KO, KP, n): #формфактор, нулевое приближение; mode: 0 - short/long; 1 - charged;
         s = (x*1e3)**2 
         F = KR * self.BW_Rho(s) + KO * self.BW_Omg(s) + n * KP * self.BW_Phi(s)
@@ -286,7 +350,8 @@ class MDVM():
         KO = CO/6.
         KP = CP/3.
         
-        F1 = self.F0(x, KR[0], KO[0], KP[0], n)
+        bw_rho, bw_omg, bw_phi = self.fixed_bw(x)
+        F1 = KR[0] * bw_rho + KO[0] * bw_omg + n * KP[0] * bw_phi
         m3, w3 = par[6], par[7] #2150, 350
         m4, w4 = par[8], par[9]
         m5, w5 = par[10], par[11]
@@ -385,4 +450,319 @@ class MDVM():
         s = (x*1e3)**2
         M_K = self.mKC if mode else self.mK0
         constant = (np.pi/3.) * (self.ALPHA**2) * self.C
-        return cs*s/(constant * ( self.BETA(s, M_K)**3 ) )
\ No newline at end of file
+        return cs*s/(constant * ( self.BETA(s, M_K)**3 ) )
+
+
+class MDVMModel():
+    """
+    Сечение `MDVM` с именованными параметрами `MDVM_PARAMETERS` (для функций потерь iminuit)
+    compiled - использовать `MDVM.Cross_Section_Compiled`
+    """
+    def __init__(self, charged: bool = False, compiled: bool = True):
+        self.mdvm = MDVM()
+        self.charged = charged
+        self.compiled = compiled
+        self.__signature__ = inspect.Signature(
+            [inspect.Parameter(p, inspect.Parameter.POSITIONAL_OR_KEYWORD) for p in ['x'] + MDVM_PARAMETERS])
+    def __call__(self, x, *par):
+        if self.compiled:
+            return self.mdvm.Cross_Section_Compiled(x, par, self.charged)
+        return self.mdvm.Cross_Section(x, par, self.charged)
+
+class MDVMLeastSquares():
+    """
+    chi2 фита сечения `MDVM` с аналитическим градиентом `mdvm_cross_section_grad`
+    
+    Использование: m = Minuit(cost, *par, grad=cost.grad) или m = cost.minuit(par, fixed)
+    """
+    errordef = Minuit.LEAST_SQUARES
+    def __init__(self, x: np.array, y: np.array, yerr: np.array, charged: bool = False):
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.w = 1/np.asarray(yerr, dtype=np.float64)**2
+        self.charged = charged
+        self.consts = MDVM().constants()
+        self.__signature__ = inspect.Signature(
+            [inspect.Parameter(p, inspect.Parameter.POSITIONAL_OR_KEYWORD) for p in MDVM_PARAMETERS])
+    def __call__(self, *par):
+        r = self.y - mdvm_cross_section(self.x, np.asarray(par, dtype=np.float64), self.charged, self.consts)
+        return np.sum(self.w*r*r)
+    def grad(self, *par):
+        cs, g = mdvm_cross_section_grad(self.x, np.asarray(par, dtype=np.float64), self.charged, self.consts)
+        return -2*(self.w*(self.y - cs)) @ g
+    def minuit(self, par: List[float], fixed: List[str] = MDVM_FIXED) -> Minuit:
+        m = Minuit(self, *par, grad=self.grad)
+        for p in fixed:
+            m.fixed[p] = True
+        return m
+
+def benchmark_fit(x: np.array, cs: np.array, cs_err: np.array, par: List[float], fixed: List[str] = MDVM_FIXED, charged: bool = False) -> pd.DataFrame:
+    """
+    Сравнить время фита сечения (simplex + migrad) с `MDVM.Cross_Section`, `MDVM.Cross_Section_Compiled` 
+    и `MDVMLeastSquares` (скомпилированное сечение с аналитическим градиентом)
+    
+    Returns
+    -------
+    pd.DataFrame
+        время фита, количество вызовов, ускорение и максимальное отличие параметров от python версии (в ошибках)
+    """
+    
+    results, values = {}, {}
+    for name in ('python', 'compiled', 'gradient'):
+        if name == 'gradient':
+            cost = MDVMLeastSquares(x, cs, cs_err, charged)
+            cost.grad(*par) # компиляция не входит во время фита
+            m = cost.minuit(par, fixed)
+        else:
+            model = MDVMModel(charged, name == 'compiled')
+            model(np.asarray(x, dtype=float)[:1], *par)
+            m = Minuit(LeastSquares(x, cs, cs_err, model), *par)
+            for p in fixed:
+                m.fixed[p] = True
+        t0 = time.perf_counter()
+        m.simplex().migrad()
+        results[name] = {'time': time.perf_counter() - t0, 'nfcn': m.nfcn, 'valid': m.valid}
+        values[name] = (np.array(m.values), np.array(m.errors))
+    df = pd.DataFrame.from_dict(results, orient='index')
+    df['speedup'] = df.loc['python', 'time']/df['time']
+    errors = np.where(values['python'][1] > 0, values['python'][1], 1)
+    df['max_diff'] = [np.max(np.abs(values[name][0] - values['python'][0])/errors) for name in df.index]
+    return df
+
+@nb.njit
+def _pv2(s, M, Mn):
+    if s <= 4*Mn*Mn:
+        return 0.
+    return np.power((s - 4*Mn**2)/(M**2 - 4*Mn**2), 3./2)*(M**2)/s
+
+@nb.njit
+def _pv2_diff(s, M, mi, mj):
+    q0 = np.sqrt((M**2 - (mi - mj)**2)*(M**2 - (mi + mj)**2))/(2*M)
+    E = np.sqrt(s)
+    q_temp = 0. if E <= (mi + mj) else (E**2 - (mi - mj)**2)*(E**2 - (mi + mj)**2)
+    q1 = np.sqrt(q_temp)/(2*E)
+    return (q1/q0)**3
+
+@nb.njit
+def _fas3(s):
+    e = np.sqrt(s)*1e-3
+    if e < 1:
+        return 5.196 + 59.17*(e-1) + 227.7 * (e-1)**2 + 147 * (e-1)**3 - 998 * (e-1)**4 - 1712 * (e-1)**5
+    return 5.196 + 80*(e-1) + 200 * (e-1)**2 + 590 * (e-1)**3 - 510 * (e-1)**4 + 220 * (e-1)**5
+
+@nb.njit
+def _fas3_rho_pipi(s):
+    e = np.sqrt(s)*1e-3
+    if e < 1.2:
+        return 1.9e-3 + 2.68e-2*(e-1.2) + 2.446e-1 * (e-1.2)**2 + 3.1487 * (e-1.2)**3 + 23.3131 * (e-1.2)**4 + 59.7669 * (e-1.2)**5
+    return 1.9e-3 + 2.33e-2*(e-1.2) + 6.65e-2 * (e-1.2)**2 - 3.84e-2 * (e-1.2)**3 + 2.36e-2 * (e-1.2)**4 - 6.5e-3 * (e-1.2)**5
+
+@nb.njit
+def _fas3_omg_pipi(s):
+    e = np.sqrt(s)*1e-3
+    if e < 1.2:
+        return 1.7e-3 + 2.61e-2*(e-1.2) + 2.67e-1 * (e-1.2)**2 + 3.61199 * (e-1.2)**3 + 27.6 * (e-1.2)**4 + 73.6433 * (e-1.2)**5
+    return 1.7e-3 + 2.18e-2*(e-1.2) + 6.89e-2 * (e-1.2)**2 - 4.52e-2 * (e-1.2)**3 + 3.25e-2 * (e-1.2)**4 - 1.09e-2 * (e-1.2)**5
+
+@nb.njit
+def _pvg(s, MX, Mn):
+    pv = ((s - Mn**2)/(2*np.sqrt(s)))**3
+    pv0 = ((MX**2 - Mn**2)/(2*MX))**3
+    return pv/pv0 if pv > 0 else 0.
+
+@nb.njit
+def _bw(s, MX, W):
+    return (MX**2)/(MX**2 - s - 1j*MX*W)
+
+@nb.njit
+def mdvm_cross_section(x, par, charged, consts):
+    """
+    Сечение МДВМ (`MDVM.Cross_Section`) для массива x (GeV) и параметров par за один проход
+    consts - массы, ширины и константы из `MDVM.constants`
+    """
+    mRho, mOmg, mPhi, mK0, mP0, mKC, mPC, mKstar, w0Rho, w0Omg, w0Phi, ALPHA, C = consts
+    n = 1. if charged else par[0]
+    cr3 = 1 - (par[1] + par[2] + par[3])
+    co_sum = par[20] + par[21] + par[22] + par[23]
+    cp2 = 3/2. - co_sum/2 - (par[4] + par[5])
+    sign = 1. if charged else -1.
+    KR0, KR1, KR2, KR3 = sign*par[1]/2., sign*par[2]/2., sign*par[3]/2., sign*cr3/2.
+    KO0, KO1, KO2, KO3 = par[20]/6., par[21]/6., par[22]/6., par[23]/6.
+    KP0, KP1, KP2 = par[4]/3., par[5]/3., cp2/3.
+    m3, w3 = par[6], par[7]
+    m4, w4 = par[8], par[9]
+    m5, w5 = par[10], par[11]
+    m6, w6 = par[12], par[13]
+    m1, w1 = par[14], par[15]
+    m2, w2 = par[16], par[17]
+    m7, w7 = par[18], par[19]
+    mEta = 547.862
+    M_K = mKC if charged else mK0
+    constant = (np.pi/3.) * (ALPHA**2) * C
+    ost_omg = 1 - 0.084 - 0.0153 - 0.892
+    ost_phi = 1 - 0.492 - 0.34 - 0.1524 - 0.01303
+    
+    cs = np.empty(x.size)
+    for i in range(x.size):
+        if x[i] < 0.4976*2:
+            cs[i] = 0.
+            continue
+        s = (x[i]*1e3)**2
+        # ширины
+        w_rho = w0Rho*_pv2(s, mRho, mPC)
+        w_omg = w0Omg*((0.892 + ost_omg)*(_fas3(s)/_fas3(mOmg**2)) + 0.084*_pvg(s, mOmg, mP0) + 0.0153*_pv2(s, mOmg, mPC))
+        w_phi = w0Phi*((0.492 + ost_phi)*_pv2(s, mPhi, mKC) + 0.34*_pv2(s, mPhi, mK0) + 
+                       0.1524*(_fas3(s)/_fas3(mPhi**2)) + 0.01303*_pvg(s, mPhi, mEta))
+        p_rho_pipi = lambda MX: _fas3_rho_pipi(s)/_fas3_rho_pipi(MX**2) if np.sqrt(s) > mRho + 2*mP0 else 0.
+        p_omg_pipi = lambda MX: _fas3_omg_pipi(s)/_fas3_omg_pipi(MX**2) if np.sqrt(s) > mOmg + 2*mP0 else 0.
+        # формфактор
+        F = KR0*_bw(s, mRho, w_rho) + KO0*_bw(s, mOmg, w_omg) + n*KP0*_bw(s, mPhi, w_phi)
+        F += KR1*_bw(s, m1, w1*_pv2_diff(s, m1, mP0, mOmg)) + KR2*_bw(s, m3, w3*p_rho_pipi(m3)) + KR3*_bw(s, m6, w6*p_rho_pipi(m6))
+        F += KO1*_bw(s, m2, w2*_pv2_diff(s, m2, mP0, mRho)) + KO2*_bw(s, m4, w4*p_omg_pipi(m4)) + KO3*_bw(s, m6, w6*p_omg_pipi(m6))
+        F += KP1*_bw(s, m5, w5*_pv2_diff(s, m5, mKC, mKstar)) + KP2*_bw(s, m7, w7*_pv2_diff(s, m7, mKC, mKstar))
+        # сечение
+        E = np.sqrt(s)/2.
+        beta = 0. if E < M_K else np.sqrt(E**2 - M_K**2)/E
+        cs[i] = constant * (beta**3) * (F.real**2 + F.imag**2) / s
+    return cs
+
+@nb.njit
+def _fas3_rho_pipi_du(u):
+    # производная _fas3_rho_pipi по u = s
+    e = np.sqrt(u)*1e-3
+    t = e - 1.2
+    if e < 1.2:
+        d = 2.68e-2 + 2*2.446e-1*t + 3*3.1487*t**2 + 4*23.3131*t**3 + 5*59.7669*t**4
+    else:
+        d = 2.33e-2 + 2*6.65e-2*t - 3*3.84e-2*t**2 + 4*2.36e-2*t**3 - 5*6.5e-3*t**4
+    return d*1e-3/(2*np.sqrt(u))
+
+@nb.njit
+def _fas3_omg_pipi_du(u):
+    # производная _fas3_omg_pipi по u = s
+    e = np.sqrt(u)*1e-3
+    t = e - 1.2
+    if e < 1.2:
+        d = 2.61e-2 + 2*2.67e-1*t + 3*3.61199*t**2 + 4*27.6*t**3 + 5*73.6433*t**4
+    else:
+        d = 2.18e-2 + 2*6.89e-2*t - 3*4.52e-2*t**2 + 4*3.25e-2*t**3 - 5*1.09e-2*t**4
+    return d*1e-3/(2*np.sqrt(u))
+
+@nb.njit
+def _pv2_diff_dm(s, M, mi, mj):
+    # (_pv2_diff, производная по M)
+    g = _pv2_diff(s, M, mi, mj)
+    if g == 0:
+        return 0., 0.
+    a2, b2 = (mi - mj)**2, (mi + mj)**2
+    q02 = (M**2 - a2)*(M**2 - b2)/(4*M**2)
+    dq02 = M/2 - a2*b2/(2*M**3)
+    return g, -3*g*dq02/(2*q02)
+
+@nb.njit
+def _p_pipi_dm(s, M, m_thr, omg):
+    # (P_RhoPiPi или P_OmgPiPi, производная по M)
+    if not(np.sqrt(s) > m_thr):
+        return 0., 0.
+    if omg:
+        f0, df0 = _fas3_omg_pipi(M**2), _fas3_omg_pipi_du(M**2)
+        g = _fas3_omg_pipi(s)/f0
+    else:
+        f0, df0 = _fas3_rho_pipi(M**2), _fas3_rho_pipi_du(M**2)
+        g = _fas3_rho_pipi(s)/f0
+    return g, -g*df0*2*M/f0
+
+@nb.njit
+def _bw_grad(s, M, w, g, dg):
+    # (Брейт-Вигнер с шириной w*g(M), производная по M, производная по w)
+    D = M**2 - s - 1j*M*w*g
+    bw = (M**2)/D
+    dD_dM = 2*M - 1j*(w*g + M*w*dg)
+    return bw, 2*M/D - (M**2)*dD_dM/(D**2), 1j*(M**3)*g/(D**2)
+
+@nb.njit
+def mdvm_cross_section_grad(x, par, charged, consts):
+    """
+    Сечение МДВМ и его аналитический градиент по параметрам par для массива x (GeV)
+    
+    Returns
+    -------
+    (cs, grad) : (numpy.array, numpy.array)
+        сечение (как `mdvm_cross_section`) и матрица производных размера (len(x), len(par))
+    """
+    mRho, mOmg, mPhi, mK0, mP0, mKC, mPC, mKstar, w0Rho, w0Omg, w0Phi, ALPHA, C = consts
+    n = 1. if charged else par[0]
+    cr3 = 1 - (par[1] + par[2] + par[3])
+    co_sum = par[20] + par[21] + par[22] + par[23]
+    cp2 = 3/2. - co_sum/2 - (par[4] + par[5])
+    sign = 1. if charged else -1.
+    KR0, KR1, KR2, KR3 = sign*par[1]/2., sign*par[2]/2., sign*par[3]/2., sign*cr3/2.
+    KO0, KO1, KO2, KO3 = par[20]/6., par[21]/6., par[22]/6., par[23]/6.
+    KP0, KP1, KP2 = par[4]/3., par[5]/3., cp2/3.
+    mEta = 547.862
+    M_K = mKC if charged else mK0
+    constant = (np.pi/3.) * (ALPHA**2) * C
+    ost_omg = 1 - 0.084 - 0.0153 - 0.892
+    ost_phi = 1 - 0.492 - 0.34 - 0.1524 - 0.01303
+    
+    cs = np.zeros(x.size)
+    grad = np.zeros((x.size, par.size))
+    dF = np.zeros(par.size, dtype=np.complex128)
+    for i in range(x.size):
+        if x[i] < 0.4976*2:
+            continue
+        s = (x[i]*1e3)**2
+        # резонансы с фиксированными массами и ширинами
+        w_rho = w0Rho*_pv2(s, mRho, mPC)
+        w_omg = w0Omg*((0.892 + ost_omg)*(_fas3(s)/_fas3(mOmg**2)) + 0.084*_pvg(s, mOmg, mP0) + 0.0153*_pv2(s, mOmg, mPC))
+        w_phi = w0Phi*((0.492 + ost_phi)*_pv2(s, mPhi, mKC) + 0.34*_pv2(s, mPhi, mK0) + 
+                       0.1524*(_fas3(s)/_fas3(mPhi**2)) + 0.01303*_pvg(s, mPhi, mEta))
+        b_rho, b_omg, b_phi = _bw(s, mRho, w_rho), _bw(s, mOmg, w_omg), _bw(s, mPhi, w_phi)
+        # возбуждения: значения и производные по массе и ширине
+        g, dg = _pv2_diff_dm(s, par[14], mP0, mOmg)
+        b_r1, b_r1_m, b_r1_w = _bw_grad(s, par[14], par[15], g, dg)
+        g, dg = _p_pipi_dm(s, par[6], mRho + 2*mP0, False)
+        b_r3, b_r3_m, b_r3_w = _bw_grad(s, par[6], par[7], g, dg)
+        g, dg = _p_pipi_dm(s, par[12], mRho + 2*mP0, False)
+        b_r6, b_r6_m, b_r6_w = _bw_grad(s, par[12], par[13], g, dg)
+        g, dg = _pv2_diff_dm(s, par[16], mP0, mRho)
+        b_o1, b_o1_m, b_o1_w = _bw_grad(s, par[16], par[17], g, dg)
+        g, dg = _p_pipi_dm(s, par[8], mOmg + 2*mP0, True)
+        b_o4, b_o4_m, b_o4_w = _bw_grad(s, par[8], par[9], g, dg)
+        g, dg = _p_pipi_dm(s, par[12], mOmg + 2*mP0, True)
+        b_o6, b_o6_m, b_o6_w = _bw_grad(s, par[12], par[13], g, dg)
+        g, dg = _pv2_diff_dm(s, par[10], mKC, mKstar)
+        b_p5, b_p5_m, b_p5_w = _bw_grad(s, par[10], par[11], g, dg)
+        g, dg = _pv2_diff_dm(s, par[18], mKC, mKstar)
+        b_p7, b_p7_m, b_p7_w = _bw_grad(s, par[18], par[19], g, dg)
+        
+        F = KR0*b_rho + KO0*b_omg + n*KP0*b_phi
+        F += KR1*b_r1 + KR2*b_r3 + KR3*b_r6
+        F += KO1*b_o1 + KO2*b_o4 + KO3*b_o6
+        F += KP1*b_p5 + KP2*b_p7
+        
+        dF[0] = 0. if charged else KP0*b_phi
+        dF[1] = sign*(b_rho - b_r6)/2.
+        dF[2] = sign*(b_r1 - b_r6)/2.
+        dF[3] = sign*(b_r3 - b_r6)/2.
+        dF[4] = n*b_phi/3. - b_p7/3.
+        dF[5] = b_p5/3. - b_p7/3.
+        dF[6], dF[7] = KR2*b_r3_m, KR2*b_r3_w
+        dF[8], dF[9] = KO2*b_o4_m, KO2*b_o4_w
+        dF[10], dF[11] = KP1*b_p5_m, KP1*b_p5_w
+        dF[12], dF[13] = KR3*b_r6_m + KO3*b_o6_m, KR3*b_r6_w + KO3*b_o6_w
+        dF[14], dF[15] = KR1*b_r1_m, KR1*b_r1_w
+        dF[16], dF[17] = KO1*b_o1_m, KO1*b_o1_w
+        dF[18], dF[19] = KP2*b_p7_m, KP2*b_p7_w
+        dF[20] = b_omg/6. - b_p7/6.
+        dF[21] = b_o1/6. - b_p7/6.
+        dF[22] = b_o4/6. - b_p7/6.
+        dF[23] = b_o6/6. - b_p7/6.
+        
+        E = np.sqrt(s)/2.
+        beta = 0. if E < M_K else np.sqrt(E**2 - M_K**2)/E
+        k = constant * (beta**3) / s
+        cs[i] = k * (F.real**2 + F.imag**2)
+        for j in range(par.size):
+            grad[i, j] = 2*k*(F.real*dF[j].real + F.imag*dF[j].imag)
+    return cs, grad
@@ -4,20 +4,24 @@ import pandas as pd
 from .style import plot_fit
 import iminuit
 from iminuit import Minuit
-from iminuit.cost import UnbinnedNLL, ExtendedUnbinnedNLL, NormalConstraint
-from scipy.integrate import quad
+from iminuit.cost import UnbinnedNLL, ExtendedUnbinnedNLL, ExtendedBinnedNLL, NormalConstraint
 from scipy.stats import poisson
 
 import os
+import time
+import inspect
 import warnings
-from typing import Callable, Union, Tuple, List, Dict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Union, Tuple, List, Dict, Optional, Hashable
 
 class Fitter():
     """
     Класс, предназначенный для фитирования гистограмм
     """
     
-    def __init__(self, data: Union[np.array, pd.Series], fit_func: callable, pars: Dict[str, float], lims: Dict[str, Tuple[float, float]], fit_range: Tuple[float, float], sigmas: Dict[str, float] = {}):
+    def __init__(self, data: Union[np.array, pd.Series], fit_func: callable, pars: Dict[str, float], lims: Dict[str, Tuple[float, float]], fit_range: Tuple[float, float], sigmas: Dict[str, float] = {},
+                 binned: Optional[bool] = None, bins: int = 500, binned_threshold: int = 100000):
         """
         Parameters
         ----------
@@ -33,17 +37,32 @@ class Fitter():
             кортеж (xmin, xmax) с областью фитирования
         sigmas : Dict[str, float]
             словарь с отклонением параметров для регуляризации (может использоваться в эксперименте, чтоб мягко ограничить параметры) (default is {})
+        binned : Optional[bool]
+            фитировать бинированным расширенным правдоподобием; None - только если событий в области фита больше `binned_threshold` (default is None)
+        bins : int
+            количество бинов в области фита для бинированного фита (default is 500)
+        binned_threshold : int
+            порог на количество событий для автоматического выбора бинированного фита (default is 100000)
         """
         
         xmin, xmax = fit_range
         self.fit_range = fit_range
         self.fit_func = fit_func
         self.data = data
-        self.cost = ExtendedUnbinnedNLL(data[(data>xmin)&(data<xmax)], self.fit_func)
+        self.bins = bins
+        self._args = (pars, lims, sigmas)
+        data_in = data[(data>xmin)&(data<xmax)]
+        self.binned = (len(data_in) > binned_threshold) if binned is None else binned
+        # небинированная функция потерь нужна и для картинок
+        self.cost = ExtendedUnbinnedNLL(data_in, self.fit_func)
+        self.fit_cost = self.cost
+        if self.binned:
+            n, xe = np.histogram(data_in, bins=bins, range=fit_range)
+            self.fit_cost = ExtendedBinnedNLL(n, xe, BinnedModel(self.fit_func))
         parnames = iminuit.util.describe(self.cost) 
         clear_dict = lambda dic: { p: dic[p] for p in set(parnames)&set(dic.keys())} #вытащить только необходимое из словаря
         self.pars, self.lims = clear_dict(pars), clear_dict(lims)
-        cost0 = self.cost
+        cost0 = self.fit_cost
         for s in clear_dict(sigmas):
             cost0 += NormalConstraint(s, self.pars[s], sigmas[s])
         self.m = Minuit(cost0, **self.pars)
@@ -60,6 +79,32 @@ class Fitter():
         if not(self.m.valid):
             warnings.warn("Fit is not valid", UserWarning)
     
+    def compare_binned(self) -> pd.DataFrame:
+        """
+        Сравнить бинированный и небинированный фиты (второй фит делается с теми же начальными условиями)
+        
+        Returns
+        -------
+        pd.DataFrame
+            значения и ошибки параметров в обоих фитах, 
+            pull = (binned - unbinned)/unbinned_err
+        """
+        
+        pars, lims, sigmas = self._args
+        other = Fitter(self.data, self.fit_func, pars, lims, self.fit_range, sigmas, binned=not(self.binned), bins=self.bins)
+        other.fit()
+        if self.m.fmin is None:
+            self.fit()
+        binned, unbinned = (self, other) if self.binned else (other, self)
+        df = pd.DataFrame({
+            'binned': binned.get_params(), 
+            'binned_err': binned.get_sigmas(exclude=[]), 
+            'unbinned': unbinned.get_params(), 
+            'unbinned_err': unbinned.get_sigmas(exclude=[]),
+        })
+        df['pull'] = (df['binned'] - df['unbinned'])/df['unbinned_err']
+        return df
+    
     def plot(self, hist_range: Tuple[float, float], bins: int, title: str = '', label: str = '', xtitle: str = '', ytitle: str = '', 
              errors: bool = True, alpha: float = 0.8, lw: int = 1, description: bool = True, fill_errors: bool = False,
              plot_bkg: bool = False, bbox_color: str = 'ivory', fit_color: str = None, data_color: str = None, print_fixed_vals: bool = True):
@@ -170,6 +215,99 @@ class Fitter():
             sigmas_dict.pop(ex, None)
         return sigmas_dict
     
+def _fit_chunk(args) -> List[dict]:
+    """
+    Последовательно фитировать точки одного куска, начиная каждый фит с результата предыдущей точки
+    """
+    chunk, fit_func, pars, lims, fit_range, sigmas, warm_start, warm_exclude, fitter_kwargs = args
+    rows, prev = [], None
+    for key, data in chunk:
+        pars0 = pars.copy()
+        if warm_start and (prev is not None):
+            pars0.update({p: v for p, v in prev.items() if p not in warm_exclude})
+        row = {'point': key}
+        t0 = time.perf_counter()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                fitter = Fitter(data, fit_func, pars0, lims, fit_range, sigmas, **fitter_kwargs)
+                fitter.fit()
+            m = fitter.m
+            for p in m.parameters:
+                row[p], row[f'{p}_err'] = m.values[p], m.errors[p]
+            row['n_sig'], row['n_sig_err'] = fit_func.get_nsig(m)
+            row['n_bkg'], row['n_bkg_err'] = fit_func.get_nbkg(m)
+            row['valid'], row['nfcn'], row['error'] = m.valid, m.nfcn, None
+            prev = fitter.get_params() if m.valid else prev
+        except Exception as e:
+            row['valid'], row['error'] = False, repr(e)
+        row['time'] = time.perf_counter() - t0
+        rows.append(row)
+    return rows
+
+def fit_points(datas: Dict[Hashable, Union[np.array, pd.Series]], fit_func: callable, pars: Dict[str, float], lims: Dict[str, Tuple[float, float]], 
+               fit_range: Tuple[float, float], sigmas: Dict[str, float] = {}, n_workers: Optional[int] = None, warm_start: bool = True, 
+               warm_exclude: List[str] = ['n_sig', 'n_bkg'], min_chunk: int = 5, **fitter_kwargs) -> pd.DataFrame:
+    """
+    Фитировать одной моделью много точек (например, по энергиям) параллельно
+    
+    Точки сортируются по ключу и делятся на не более чем `n_workers` непрерывных кусков (не меньше `min_chunk` точек), 
+    каждый кусок фитируется в своём процессе последовательно: фит точки начинается с результата соседней (предыдущей) точки
+    
+    Parameters
+    ----------
+    datas : Dict[Hashable, Union[np.array, pd.Series]]
+        словарь точка -> данные для фита
+    fit_func : callable
+        функция фита (Fit1, Fit2, FitPoly2, ...)
+    pars, lims, fit_range, sigmas
+        как в `Fitter` (например, `lims` и `sigmas` из `get_limits`/`get_sigmas` фита моделирования)
+    n_workers : Optional[int]
+        количество процессов (None - по числу ядер, 1 - без пула) (default is None)
+    warm_start : bool
+        начинать фит с результата соседней точки (default is True)
+    warm_exclude : List[str]
+        параметры, которые всегда начинаются с `pars` (default is `['n_sig', 'n_bkg']`)
+    min_chunk : int
+        минимальное количество точек в куске, чтобы тёплый старт работал и при большом числе процессов (default is 5)
+    fitter_kwargs
+        передаются в `Fitter` (binned, bins, ...)
+        
+    Returns
+    -------
+    pd.DataFrame
+        по строке на точку: значения и ошибки параметров, n_sig/n_bkg с ошибками, 
+        valid, nfcn, error (текст исключения, если фит упал) и time (время фита, с)
+    """
+    
+    keys = sorted(datas)
+    n_chunks = min(len(keys)//max(min_chunk, 1), n_workers if n_workers is not None else (os.cpu_count() or 1))
+    chunks = [[(keys[i], datas[keys[i]]) for i in part] for part in np.array_split(np.arange(len(keys)), max(n_chunks, 1))]
+    tasks = [(chunk, fit_func, pars, lims, fit_range, sigmas, warm_start, warm_exclude, fitter_kwargs) for chunk in chunks if len(chunk) > 0]
+    if n_workers == 1:
+        results = [_fit_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_fit_chunk, tasks))
+    return pd.DataFrame([row for rows in results for row in rows]).set_index('point')
+
+class BinnedModel():
+    """
+    Интегралы функции фита `fit_func` по бинам (кумулятивно) для ExtendedBinnedNLL, 
+    интегрирование по бину квадратурой Гаусса-Лежандра с `n_nodes` узлами
+    """
+    def __init__(self, fit_func: callable, n_nodes: int = 5):
+        self.fit_func = fit_func
+        self.nodes, self.weights = np.polynomial.legendre.leggauss(n_nodes)
+        parnames = iminuit.util.describe(fit_func)[1:]
+        self.__signature__ = inspect.Signature(
+            [inspect.Parameter(p, inspect.Parameter.POSITIONAL_OR_KEYWORD) for p in ['xe'] + list(parnames)])
+    def __call__(self, xe, *pars):
+        half, centers = (xe[1:] - xe[:-1])/2, (xe[1:] + xe[:-1])/2
+        x = (centers[:, None] + half[:, None]*self.nodes[None, :]).ravel()
+        density = self.fit_func(x, *pars)[1].reshape(len(centers), -1)
+        return np.concatenate([[0], np.cumsum(half*(density @ self.weights))])
+    
 class Fit1():
     def __init__(self, fit_range):
         self.fit_range = fit_range
@@ -272,13 +410,39 @@ def cruijff(x, m, sL, sR, aL, aR):
     denom = 2*np.where(x<m, (sL**2 + aL*(x-m)**2), (sR**2 + aR*(x-m)**2) )
     return np.exp(-(x-m)**2/denom)
 
+# узлы и веса квадратуры Гаусса-Лежандра на [-1, 1]
+GL_NODES, GL_WEIGHTS = np.polynomial.legendre.leggauss(32)
+
+@nb.njit(parallel=False, fastmath=True)
+def cruijff_integral_gl(m, sL, sR, aL, aR, xmin, xmax, nodes, weights, n_sub):
+    """
+    Интеграл `cruijff` на [xmin, xmax] составной квадратурой Гаусса-Лежандра:
+    левая и правая (относительно m) части интегрируются отдельно, каждая разбивается на n_sub отрезков
+    """
+    xm = min(max(m, xmin), xmax)
+    I = 0.
+    for a, b, s, al in ((xmin, xm, sL, aL), (xm, xmax, sR, aR)):
+        if b <= a:
+            continue
+        h = (b - a)/n_sub
+        for k in range(n_sub):
+            c = a + (k + 0.5)*h
+            for i in range(nodes.shape[0]):
+                x = c + 0.5*h*nodes[i]
+                I += 0.5*h*weights[i]*np.exp(-(x-m)**2/(2*(s**2 + al*(x-m)**2)))
+    return I
+
+@lru_cache(maxsize=4096)
+def cruijff_integral(m, sL, sR, aL, aR, xmin, xmax):
+    """
+    Интеграл `cruijff` на [xmin, xmax] (с кэшем по параметрам)
+    """
+    return cruijff_integral_gl(m, sL, sR, aL, aR, xmin, xmax, GL_NODES, GL_WEIGHTS, 16)
+
 def cruijff_norm(x, m, sL, sR, aL, aR, fit_range):
     xmin, xmax = fit_range
-#     try:
-    I = quad(cruijff, xmin, xmax, args=(m, sL, sR, aL, aR))[0]
+    I = cruijff_integral(float(m), float(sL), float(sR), float(aL), float(aR), float(xmin), float(xmax))
     return cruijff(x, m, sL, sR, aL, aR)/I
-#     except:
-#         return np.ones_like(x)/(xmax-xmin)
 
 @nb.njit(parallel=False, fastmath=True)
 def linear(x, y0, dy, fit_range):
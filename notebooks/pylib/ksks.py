@@ -3,54 +3,218 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import uproot
 import os
-from .preprocess import HandlerKSKS
+import re
+import json
+import hashlib
+import warnings
+import io
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Callable
+from .preprocess import HandlerKSKS, KSKSCutChain
 from .statistics import efficiency_error
 
-def preprocess_point(row, df_4pic, season='19', force_process=False, print_log=True):
+CACHE_DIR = '../csv/ksks/data'
+
+# каты предобработки, от них (и от исходного дерева) зависит ключ кэша
+PREPROCESS_CUTS = {
+    'cut_dedx': 2500,
+    'cut_z': 12,
+    'cut_align': 0.8,
+    'col_th': 0.4,
+    'col_phi': 0.4,
+    'cut_en': 250,
+    'cut_mom': 120,
+}
+
+# колонки, нужные для `process_point`
+PROCESS_COLUMNS = ['ksth', 'ksphi', 'ksminv', 'ksptot', 'kslen', 'emeas', 'finalstate_id']
+
+def tree_paths(row, season: str = '19') -> dict:
+    """
+    Пути к деревьям эксперимента ('exp'), мультиадронов ('mlt') и 4pi ('4pi') для строки `row`
+    (None, если такого моделирования для точки нет)
+    """
+    paths = {'exp': row['exp_tree'], 'mlt': None, '4pi': None}
+    if not(np.isnan(row['mlt_raw'])):
+        paths['mlt'] = f'/store17/petrov/data/kskl20/tr_ph/multi/{season}/tr_ph_run0{row["mlt_raw"]:.0f}.root'
+    if not(np.isnan(row['4pi_raw'])):
+        paths['4pi'] = f'/store17/petrov/data/kskl20/tr_ph/4pi/{season}/tr_ph_run0{row["4pi_raw"]:.0f}.root'
+    return paths
+
+def cache_key(tree_path: str, cuts: dict = PREPROCESS_CUTS) -> str:
+    """
+    Ключ кэша: хэш пути к исходному дереву и катов предобработки 
+    (само дерево не открывается, так что ключ одинаковый и там, где дерево недоступно; 
+    размер и время изменения дерева хранятся рядом с кэшем, см. `source_fingerprint`)
+    """
+    description = json.dumps({'tree': str(tree_path), 'cuts': cuts}, sort_keys=True)
+    return hashlib.sha1(description.encode()).hexdigest()[:10]
+
+def source_fingerprint(tree_path: str) -> Optional[dict]:
+    """
+    Размер и время изменения исходного дерева (None, если дерево недоступно)
+    """
+    if not(os.path.isfile(tree_path)):
+        return None
+    stat = os.stat(tree_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def fingerprint_filename(filename: str) -> str:
+    """
+    Имя json-файла с `source_fingerprint` дерева, из которого получен кэш (или счётчики) filename
+    """
+    return os.path.splitext(filename)[0] + '.source.json'
+
+def write_fingerprint(filename: str, tree_path: str):
+    """
+    Сохранить `source_fingerprint` дерева рядом с filename (ничего не делает, если дерево недоступно)
+    """
+    fingerprint = source_fingerprint(tree_path)
+    if fingerprint is not None:
+        with open(fingerprint_filename(filename), 'w') as f:
+            json.dump(dict(fingerprint, tree=str(tree_path)), f)
+
+def source_changed(filename: str, tree_path: str) -> bool:
+    """
+    Изменилось ли дерево после того, как из него получен filename. 
+    Проверяется, только если дерево доступно и отпечаток сохранён, иначе - False
+    """
+    sidecar = fingerprint_filename(filename)
+    if not(os.path.isfile(sidecar)):
+        return False
+    fingerprint = source_fingerprint(tree_path)
+    if fingerprint is None:
+        return False
+    with open(sidecar) as f:
+        saved = json.load(f)
+    return (saved['size'] != fingerprint['size']) or (saved['mtime'] != fingerprint['mtime'])
+
+def cache_filename(kind: str, elabel: str, key: str, fmt: str = 'parquet') -> str:
+    """
+    Имя файла кэша для дерева `kind` ('exp', 'mlt', '4pi') точки `elabel`
+    """
+    return os.path.join(CACHE_DIR, f'df_cut_{kind}_{elabel}_{key}.{fmt}')
+
+def legacy_cache_filename(kind: str, elabel: str) -> str:
+    """
+    Имя файла кэша старого формата (csv без ключа)
+    """
+    return os.path.join(CACHE_DIR, f'df_cut_{kind}_{elabel}.csv')
+
+def find_cache(kind: str, elabel: str, key: str, tree_path: Optional[str] = None) -> Optional[str]:
+    """
+    Найти кэш с ключом `key` (None, если его нет). 
+    Если для точки есть только кэши с другими ключами (поменялись каты или путь к дереву), они считаются устаревшими: 
+    выдаётся предупреждение и кэш не используется (кэш старого формата без ключа - см. `legacy_cache_filename`). 
+    tree_path - проверить, что дерево не менялось после записи кэша (`source_changed`; None - не проверять)
+    """
+    for fmt in ('parquet', 'csv'):
+        filename = cache_filename(kind, elabel, key, fmt)
+        if os.path.isfile(filename):
+            if (tree_path is not None) and source_changed(filename, tree_path):
+                warnings.warn(f'Stale cache for {kind} {elabel} (source tree changed): {filename}', UserWarning)
+                return None
+            return filename
+    pattern = re.compile(rf'df_cut_{re.escape(kind)}_{re.escape(str(elabel))}_[0-9a-f]{{10}}\.(parquet|csv)$')
+    stale = [f for f in os.listdir(CACHE_DIR) if pattern.match(f)] if os.path.isdir(CACHE_DIR) else []
+    if len(stale) > 0:
+        warnings.warn(f'Stale cache for {kind} {elabel} (cuts or source tree changed): {stale}', UserWarning)
+    return None
+
+def write_cache(df: pd.DataFrame, kind: str, elabel: str, key: str, fmt: str = 'parquet', tree_path: Optional[str] = None) -> str:
+    """
+    Сохранить `df` в кэш (parquet сохраняет типы колонок и индекс (entry, subentry));
+    если parquet недоступен, сохраняется csv. Возвращает имя файла. 
+    tree_path - сохранить рядом `source_fingerprint` исходного дерева
+    """
+    filename = cache_filename(kind, elabel, key, 'csv')
+    if fmt == 'parquet':
+        try:
+            df.to_parquet(cache_filename(kind, elabel, key, 'parquet'))
+            filename = cache_filename(kind, elabel, key, 'parquet')
+        except ImportError:
+            warnings.warn('Parquet engine is not available, csv is used', UserWarning)
+    if not(filename.endswith('.parquet')):
+        df.to_csv(filename)
+    if tree_path is not None:
+        write_fingerprint(filename, tree_path)
+    return filename
+
+def read_cache(filename: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Прочитать кэш (parquet или csv), columns - прочитать только эти колонки
+    """
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename, columns=columns)
+    usecols = None if columns is None else ['entry', 'subentry'] + list(columns)
+    return pd.read_csv(filename, index_col=['entry', 'subentry'], usecols=usecols)
+
+def counts_filename(kind: str, elabel: str, tree_path: str) -> str:
+    """
+    Имя файла с количеством событий в дереве `kind` точки `elabel` (ключ - только путь к дереву, см. `cache_key`)
+    """
+    return os.path.join(CACHE_DIR, f'counts_{kind}_{elabel}_{cache_key(tree_path, {})}.json')
+
+def event_counts(kind: str, elabel: str, tree_path: str, tree=None, force_process: bool = False, check_source: bool = True) -> dict:
+    """
+    Количество событий в исходном дереве: {'entries': полное число событий, 'finalstate_id': {id: число событий}}
+    
+    Считается один раз (по одной ветке finalstate_id) и сохраняется рядом с кэшем катов, 
+    дальше дерево не открывается. tree - уже открытое дерево (иначе откроется по `tree_path`, если нужно). 
+    check_source - пересчитать, если дерево доступно и изменилось (`source_changed`)
+    """
+    filename = counts_filename(kind, elabel, tree_path)
+    fresh = not(check_source and source_changed(filename, tree_path))
+    if os.path.isfile(filename) and fresh and not(force_process):
+        with open(filename) as f:
+            counts = json.load(f)
+        counts['finalstate_id'] = {int(k): v for k, v in counts['finalstate_id'].items()}
+        return counts
+    if tree is None:
+        tree = uproot.open(tree_path)['tr_ph']
+    counts = {'tree': str(tree_path), 'entries': int(tree.num_entries), 'finalstate_id': {}}
+    if 'finalstate_id' in tree.keys():
+        ids, n = np.unique(tree['finalstate_id'].array(library='np'), return_counts=True)
+        counts['finalstate_id'] = {int(k): int(v) for k, v in zip(ids, n)}
+    with open(filename, 'w') as f:
+        json.dump(counts, f)
+    write_fingerprint(filename, tree_path)
+    return counts
+
+def preprocess_point(row, df_4pic, season='19', force_process=False, print_log=True, cache_format='parquet'):
     """
     Предварительно обработать строку `row`
     df_4pic - данные для 4pi
     force_process - не искать уже сохранённые файлы, а обработать заново
     print_log - показывать логи
+    cache_format - формат кэша: 'parquet' или 'csv'
     """
-    filename_exp = f'../csv/ksks/data/df_cut_exp_{row["elabel"]}.csv'
-    filename_mlt = f'../csv/ksks/data/df_cut_mlt_{row["elabel"]}.csv'
-    filename_4pi = f'../csv/ksks/data/df_cut_4pi_{row["elabel"]}.csv'
-    
-    tr_exp = uproot.open(row['exp_tree'])['tr_ph']
-    
-    tr_mlt = None
-    if not(np.isnan(row['mlt_raw'])):
-        tr_mlt = uproot.open(
-            f'/store17/petrov/data/kskl20/tr_ph/multi/{season}/tr_ph_run0{row["mlt_raw"]:.0f}.root')['tr_ph']
-    tr_4pi = None
-    if not(np.isnan(row['4pi_raw'])):
-        tr_4pi = uproot.open(
-            f'/store17/petrov/data/kskl20/tr_ph/4pi/{season}/tr_ph_run0{row["4pi_raw"]:.0f}.root')['tr_ph']
+    paths = tree_paths(row, season)
+    counts = {}
             
-    def preprocess_one_file(tr, filename):
-        if tr is None:
+    def preprocess_one_file(kind):
+        if paths[kind] is None:
             return None
-        hd = HandlerKSKS(tr)
+        key = cache_key(paths[kind])
+        filename = find_cache(kind, row['elabel'], key, paths[kind])
+        if (filename is not None) and not(force_process):
+            counts[kind] = event_counts(kind, row['elabel'], paths[kind])
+            return read_cache(filename)
+        tr = uproot.open(paths[kind])['tr_ph']
+        counts[kind] = event_counts(kind, row['elabel'], paths[kind], tr, force_process)
+        cuts = PREPROCESS_CUTS
+        hd = HandlerKSKS(tr, cut_dedx=cuts['cut_dedx'], cut_z=cuts['cut_z'], cut_align=cuts['cut_align'])
         df = hd.get_good_kaons()
-        df_cut = HandlerKSKS.collinear_cut(df, 0.4, 0.4, plot=False)
-        df_cut = HandlerKSKS.sum_energy_cut(df_cut, cut_en=250, plot=False)
-        df_cut = HandlerKSKS.kaon_mom_cut(df_cut, cut_mom=120, plot=False)
-        df_cut.to_csv(filename)
+        chain = KSKSCutChain(cuts['col_th'], cuts['col_phi'], cut_en=cuts['cut_en'], cut_mom=cuts['cut_mom'], cut_flight=None, cut_mass=None)
+        df_cut, _ = chain.apply(df)
+        write_cache(df_cut, kind, row['elabel'], key, cache_format, paths[kind])
         return df_cut
     
-    if not(os.path.isfile(filename_exp)) or force_process:
-        df_cut_exp = preprocess_one_file(tr_exp, filename_exp)
-    else:
-        df_cut_exp = pd.read_csv(filename_exp, index_col=['entry', 'subentry'])
-    if not(os.path.isfile(filename_mlt)) or force_process:
-        df_cut_mlt = preprocess_one_file(tr_mlt, filename_mlt)
-    else:
-        df_cut_mlt = pd.read_csv(filename_mlt, index_col=['entry', 'subentry'])
-    if not(os.path.isfile(filename_4pi)) or force_process:
-        df_cut_4pi = preprocess_one_file(tr_4pi, filename_4pi)
-    else:
-        df_cut_4pi = pd.read_csv(filename_4pi, index_col=['entry', 'subentry'])
+    df_cut_exp = preprocess_one_file('exp')
+    df_cut_mlt = preprocess_one_file('mlt')
+    df_cut_4pi = preprocess_one_file('4pi')
         
     cs_vis = np.interp(row['emeas'], df_4pic['ebeam'], df_4pic['cs_vis'])
     
@@ -60,14 +224,14 @@ def preprocess_point(row, df_4pic, season='19', force_process=False, print_log=T
     if df_cut_4pi is not None:
         n_4pi_bkg += df_cut_4pi.index.droplevel(1).nunique()
         n_bkg += df_cut_4pi.index.droplevel(1).nunique()
-        n_4pi += len(tr_4pi.arrays(['finalstate_id']))
+        n_4pi += counts['4pi']['entries']
         
     if df_cut_mlt is not None:
         n_4pi_bkg_mlt = df_cut_mlt.query('finalstate_id==2').index.droplevel(1).nunique()
         n_bkg_mlt = df_cut_mlt.index.droplevel(1).nunique()
         n_4pi_bkg += n_4pi_bkg_mlt
         n_bkg += n_bkg_mlt
-        n_4pi += len(tr_mlt.arrays(['finalstate_id'], 'finalstate_id==2'))
+        n_4pi += counts['mlt']['finalstate_id'].get(2, 0)
         part_4pic = (n_4pi_bkg_mlt + 1)/(n_bkg_mlt + 2)
         part_4pic_err = efficiency_error(n_4pi_bkg_mlt, n_bkg_mlt)
         
@@ -95,48 +259,36 @@ def preprocess_point(row, df_4pic, season='19', force_process=False, print_log=T
     }
     return d0
 
-def process_point(row, df_4pic: pd.DataFrame, season: str = '19', print_log: bool = True) -> dict:
+def process_point(row, df_4pic: pd.DataFrame, season: str = '19', print_log: bool = True, check_source: bool = False) -> dict:
     """
     Дообработать строку `row`
     df_4pic - данные для 4pi
     print_log - показывать логи
+    check_source - проверить, что исходные деревья не менялись после `preprocess_point` (`source_changed`); 
+    по умолчанию исходные деревья не трогаются вовсе, используются только кэши
     """
-    filename_exp = f'../csv/ksks/data/df_cut_exp_{row["elabel"]}.csv'
-    filename_mlt = f'../csv/ksks/data/df_cut_mlt_{row["elabel"]}.csv'
-    filename_4pi = f'../csv/ksks/data/df_cut_4pi_{row["elabel"]}.csv'
-    
-    
-    tr_exp = uproot.open(row['exp_tree'])['tr_ph']
+    paths = tree_paths(row, season)
+    counts = {}
     
-    tr_mlt = None
-    if not(np.isnan(row['mlt_raw'])):
-        tr_mlt = uproot.open(
-            f'/store17/petrov/data/kskl20/tr_ph/multi/{season}/tr_ph_run0{row["mlt_raw"]:.0f}.root')['tr_ph']
-    tr_4pi = None
-    if not(np.isnan(row['4pi_raw'])):
-        tr_4pi = uproot.open(
-            f'/store17/petrov/data/kskl20/tr_ph/4pi/{season}/tr_ph_run0{row["4pi_raw"]:.0f}.root')['tr_ph']
-            
-    
-    def process_one_file(df):
-        if df is None:
+    def process_one_file(kind):
+        if paths[kind] is None:
             return None
-        df_cut = HandlerKSKS.collinear_cut(df, 0.25, 0.15)
-        df_cut = HandlerKSKS.sum_energy_cut(df_cut, cut_en=100)
-        df_cut = HandlerKSKS.kaon_mom_cut(df_cut, cut_mom=60)
-        df_cut = HandlerKSKS.flight_cut(df_cut, cut_flight=0.1)
-        df_cut = HandlerKSKS.ksminv_cut(df_cut, cut_mass=25)
+        filename = find_cache(kind, row['elabel'], cache_key(paths[kind]), paths[kind] if check_source else None)
+        if filename is None:
+            filename = legacy_cache_filename(kind, row['elabel'])
+            if not(os.path.isfile(filename)):
+                return None
+            warnings.warn(f'Legacy cache without key is used for {kind} {row["elabel"]}: {filename}', UserWarning)
+        counts[kind] = event_counts(kind, row['elabel'], paths[kind], check_source=check_source)
+        df = read_cache(filename, columns=PROCESS_COLUMNS)
+        df_cut, _ = KSKSCutChain(0.25, 0.15, cut_en=100, cut_mom=60, cut_flight=0.1, cut_mass=25).apply(df)
         return df_cut
     
-    df_cut_exp = process_one_file(
-        pd.read_csv(filename_exp, index_col=['entry', 'subentry'])
-    ) if os.path.isfile(filename_exp) else None
-    df_cut_mlt = process_one_file(
-        pd.read_csv(filename_mlt, index_col=['entry', 'subentry'])
-    ) if os.path.isfile(filename_mlt) else None
-    df_cut_4pi = process_one_file(
-        pd.read_csv(filename_4pi, index_col=['entry', 'subentry'])
-    ) if os.path.isfile(filename_4pi) else None
+    df_cut_exp = process_one_file('exp')
+    df_cut_mlt = process_one_file('mlt')
+    df_cut_4pi = process_one_file('4pi')
+    if df_cut_exp is None:
+        raise FileNotFoundError(f'No cache for exp {row["elabel"]}, run preprocess_point first')
     
     cs_vis = np.interp(row['emeas'], df_4pic['ebeam'], df_4pic['cs_vis'])
     
@@ -146,7 +298,7 @@ def process_point(row, df_4pic: pd.DataFrame, season: str = '19', print_log: boo
     if df_cut_4pi is not None:
         n_4pi_bkg += df_cut_4pi.index.droplevel(1).nunique()
         n_bkg += df_cut_4pi.index.droplevel(1).nunique()
-        n_4pi += len(tr_4pi.arrays(['finalstate_id']))
+        n_4pi += counts['4pi']['entries']
         
     if df_cut_mlt is not None:
 #         n_4pi_bkg += df_cut_mlt.query('finalstate_id==2').index.droplevel(1).nunique()
@@ -156,7 +308,7 @@ def process_point(row, df_4pic: pd.DataFrame, season: str = '19', print_log: boo
         n_bkg_mlt = df_cut_mlt.index.droplevel(1).nunique()
         n_4pi_bkg += n_4pi_bkg_mlt
         n_bkg += n_bkg_mlt
-        n_4pi += len(tr_mlt.arrays(['finalstate_id'], 'finalstate_id==2'))
+        n_4pi += counts['mlt']['finalstate_id'].get(2, 0)
         part_4pic = (n_4pi_bkg_mlt + 1)/(n_bkg_mlt + 2)
         part_4pic_err = efficiency_error(n_4pi_bkg_mlt, n_bkg_mlt)
         
@@ -183,4 +335,39 @@ def process_point(row, df_4pic: pd.DataFrame, season: str = '19', print_log: boo
         'part_4pic': part_4pic,
         'part_4pic_err': part_4pic_err,        
     }
-    return d0
\ No newline at end of file
+    return d0
+
+def _run_point(args) -> dict:
+    """
+    Обработать одну точку функцией `func`, перехватив её вывод (stdout, stderr), предупреждения и ошибки
+    """
+    func, row, df_4pic, kwargs = args
+    log = io.StringIO()
+    with redirect_stdout(log), redirect_stderr(log), warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            d0 = dict(func(row, df_4pic, **kwargs), error=None)
+        except Exception:
+            d0 = {'elabel': row['elabel'], 'emeas': row['emeas'], 'error': traceback.format_exc()}
+    for w in caught:
+        log.write(warnings.formatwarning(w.message, w.category, w.filename, w.lineno, w.line))
+    d0['log'] = log.getvalue()
+    return d0
+
+def run_points(total_info: pd.DataFrame, df_4pic: pd.DataFrame, func: Callable = process_point, 
+               n_workers: Optional[int] = None, **kwargs) -> pd.DataFrame:
+    """
+    Обработать все точки `total_info` функцией `func` (`preprocess_point` или `process_point`) 
+    в пуле из `n_workers` процессов (None - по числу ядер, 1 - без пула)
+    kwargs - передаются в `func` (season, print_log, ...)
+    
+    Возвращает pd.DataFrame в порядке строк `total_info` (с тем же индексом). 
+    Колонка 'log' содержит вывод обработки точки (stdout, stderr и предупреждения), колонка 'error' - traceback, если точка упала (иначе None)
+    """
+    tasks = [(func, row, df_4pic, kwargs) for _, row in total_info.iterrows()]
+    if n_workers == 1:
+        results = [_run_point(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_run_point, tasks))
+    return pd.DataFrame(results, index=total_info.index)
@@ -2,11 +2,12 @@ import numpy as np
 import pandas as pd
 import uproot
 import warnings
+import time
 import awkward as ak
 import vector
 import matplotlib.pyplot as plt
 
-from typing import Tuple
+from typing import Tuple, Optional, List
 
 def get_x(df: pd.DataFrame) -> Tuple[pd.Series, pd.Series]:
     """
@@ -76,50 +77,144 @@ def read_tree(root_file, mc=False, align_cut=0.8, z_cut=12, dedx_cut=2000, sim_p
     return df.set_index('ebeam')
 
 
+def _badruns() -> np.ndarray:
+    """
+    Номера плохих заходов
+    """
+    
+    return np.loadtxt('pylib/badruns.dat')
+
+def _mark_badruns(dat_glob: pd.DataFrame) -> pd.DataFrame:
+    """
+    Отметить события из плохих заходов колонкой `badrun`
+    """
+    
+    dat_glob['badrun'] = dat_glob.runnum.isin(_badruns())
+    return dat_glob
+
+def _shift_entries(df: pd.DataFrame, entries: np.ndarray) -> pd.DataFrame:
+    """
+    Заменить локальные номера событий порции (уровень `entry`) на номера событий в дереве `entries`
+    """
+    
+    if isinstance(df.index, pd.MultiIndex):
+        levels = [df.index.get_level_values(i) for i in range(1, df.index.nlevels)]
+        df.index = pd.MultiIndex.from_arrays([entries[df.index.get_level_values(0)], *levels], names=df.index.names)
+    else:
+        df.index = pd.Index(entries[df.index], name='entry')
+    return df
+
+def _to_pandas(arrs, entry_start=None) -> pd.DataFrame:
+    """
+    `ak.to_pandas`, сохраняющий номера событий дерева для порции, начинающейся с `entry_start`
+    """
+    
+    df = ak.to_pandas(arrs)
+    if entry_start:
+        df = _shift_entries(df, np.arange(entry_start, entry_start + len(arrs)))
+    return df
+
+def benchmark_engines(handler, n_repeat: int = 3, **kwargs) -> pd.DataFrame:
+    """
+    Сравнить скорость движков 'pandas' и 'awkward' в `get_good_kaons`
+    
+    Parameters
+    ----------
+    handler : Union[Handler, HandlerKSKS]
+        обработчик дерева
+    n_repeat : int
+        количество запусков каждого движка (default is 3)
+    kwargs
+        остальные аргументы `get_good_kaons`
+    
+    Returns
+    -------
+    pd.DataFrame
+        лучшее время по запускам ('time', с), ускорение относительно 'pandas' ('speedup') 
+        и совпадение результата с движком 'pandas' ('identical')
+    """
+    
+    times, results = {}, {}
+    for engine in ('pandas', 'awkward'):
+        times[engine] = np.inf
+        for _ in range(n_repeat):
+            time0 = time.perf_counter()
+            results[engine] = handler.get_good_kaons(engine=engine, **kwargs)
+            times[engine] = min(times[engine], time.perf_counter() - time0)
+    
+    bench = pd.DataFrame.from_dict(times, orient='index', columns=['time'])
+    bench['speedup'] = bench.loc['pandas', 'time'] / bench['time']
+    identical = []
+    for engine in bench.index:
+        try:
+            pd.testing.assert_frame_equal(results['pandas'], results[engine])
+            identical.append(True)
+        except AssertionError:
+            identical.append(False)
+    bench['identical'] = identical
+    return bench
+
+def _charge_means(values: np.ndarray, first: np.ndarray, second: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Средние `values` по последней оси отдельно по строкам из масок `first` и `second` 
+    (то же, что `pivot_table(..., columns=['tcharge'])` с усреднением), NaN если строк нет
+    """
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_first = np.where(first, values, 0).astype(np.float64).sum(axis=-1) / first.sum(axis=-1)
+        mean_second = np.where(second, values, 0).astype(np.float64).sum(axis=-1) / second.sum(axis=-1)
+    return mean_first.astype(values.dtype), mean_second.astype(values.dtype)
+
 class Handler:
+    branches = ['nt', 'nks', 'emeas', 'tz', 'tptot', 'tdedx', 'tcharge', 'trho', 'tth', 'tphi', 'tnhit', 'tchi2r', 'tchi2z',
+                'ksptot', 'ksminv', 'ksalign', 'ksvind', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi', 'phen', 'phth', 'phphi',
+                'ebeam', 'lumoff', 'lumofferr', 'runnum', 'finalstate_id', 'trigbits']
+    tracks_values = ['trho', 'tz', 'tdedx', 'tptot', 'tth', 'tphi']
+    kaons_values = ['ksminv', 'ksalign', 'ksptot', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi']
+    
     def __init__(self, tree, cut_dedx=2500, cut_z=12, cut_align=0.8):
         self.tree = tree
         self.cut_dedx = cut_dedx
         self.cut_z = cut_z
         self.cut_align = cut_align
-    def get_dat_tracks(self):
-        e0 = self.tree['emeas'].array()[0]
+    def _arrays_tracks(self, entry_start=None, entry_stop=None):
+        e0 = self.tree['emeas'].array(entry_stop=1)[0]
         pidedx = '5.58030e+9 / (tptot + 40.)**3 + 2.21228e+3 - 3.77103e-1 * tptot - tdedx'
-        arrs = self.tree.arrays(['tz', 'tptot', 'tdedx', 'tcharge', 'trho', 'tth', 'tphi'], 
+        return self.tree.arrays(['tz', 'tptot', 'tdedx', 'tcharge', 'trho', 'tth', 'tphi'], 
                          f'(nt>=2)&(nks>0)&(tnhit>6)&(abs(pidedx)<{self.cut_dedx})&(tchi2r<20)&(tchi2z<20)&(abs(tz)<{self.cut_z})&(tptot<{e0})&(tptot>40)', 
-                         aliases={'pidedx': pidedx})
-        dat_tracks = ak.to_pandas(arrs)
+                         aliases={'pidedx': pidedx}, entry_start=entry_start, entry_stop=entry_stop)
+    def _arrays_kaons(self, entry_start=None, entry_stop=None):
+        dlt_mass = 'abs(ksminv-497.6)'
+        cuts = f'(nt>=2)&(nks>0)&(ksalign>{self.cut_align})&(dlt_mass<200)'
+        return self.tree.arrays(['ksptot', 'ksminv', 'ksalign', 'dlt_mass', 'ksvind', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi'], 
+                           cuts, aliases={'dlt_mass': dlt_mass}, entry_start=entry_start, entry_stop=entry_stop)
+    def get_dat_tracks(self, entry_start=None, entry_stop=None):
+        dat_tracks = _to_pandas(self._arrays_tracks(entry_start, entry_stop), entry_start)
         dat_tracks_groups = dat_tracks.groupby('entry').agg(uniques=('tz', 'count'), charge=('tcharge', 'sum'))
         idx = dat_tracks_groups.query('(uniques==2)&(charge==0)').index
         return dat_tracks.loc[idx]#.drop('tcharge', axis=1)
-    def get_dat_kaons(self):
-        dlt_mass = 'abs(ksminv-497.6)'
-        cuts = f'(nt>=2)&(nks>0)&(ksalign>{self.cut_align})&(dlt_mass<200)'
-        dat_kaons = ak.to_pandas(self.tree.arrays(['ksptot', 'ksminv', 'ksalign', 'dlt_mass', 'ksvind', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi'], 
-                           cuts, aliases={'dlt_mass': dlt_mass})).loc[:, :, :1]
+    def get_dat_kaons(self, entry_start=None, entry_stop=None):
+        dat_kaons = _to_pandas(self._arrays_kaons(entry_start, entry_stop), entry_start).loc[:, :, :1]
         dat_kaons = dat_kaons.reset_index().drop('subsubentry', axis=1).set_index(['entry', 'subentry'])
         kaons = dat_kaons.sort_values(by=['dlt_mass']).reset_index().drop_duplicates(subset=['entry'], keep='first').set_index(['entry', 'subentry']).index
         dat_kaons = dat_kaons.loc[kaons]
         return dat_kaons.reset_index().drop(['subentry'], axis=1).rename({'ksvind': 'subentry'}, axis=1).set_index(['entry', 'subentry'])
-    def get_good_kaons(self, photons='one'):
+    def get_good_kaons(self, photons='one', entry_start=None, entry_stop=None, engine='pandas', emeas=None):
         """
         photons : None, 'one', 'all' -- как работать с фотонами из калориметра. None -- не добавлять их в данные, 
         'one' -- только пару с лучшим соответствием pi0, 'all' -- добавить все пары
+        entry_start, entry_stop : обработать только события дерева из этого диапазона
+        engine : 'pandas', 'awkward' -- как сопоставлять треки с каоном: через pivot/join в pandas 
+        или прямо на jagged-массивах (см. `_pair_awkward`), результат одинаковый
+        emeas : энергия пучка для массы отдачи `recoil`; None -- среднее emeas по отобранным событиям диапазона
         """
-        dat_tracks = self.get_dat_tracks()
-        dat_kaons = self.get_dat_kaons()
-        dat_glob = self.get_dat_glob()
-
-        dat_goods = dat_tracks.join(dat_kaons, how='inner')
-        goods = dat_goods.groupby('entry').agg(num=('tz', 'count')).query('num==2').index
-        dat_goods = dat_goods.reset_index().set_index('entry').loc[goods].reset_index().set_index(['entry', 'subentry'])
-
-        dat_goods['tcharge'] = np.where(dat_goods['tcharge']>0, 'p', 'n')
-        dat_goods = pd.pivot_table(dat_goods.reset_index(), values=['trho', 'tz', 'tdedx', 
-                    'tptot', 'tth', 'tphi', 'ksminv', 'ksalign', 'ksptot', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi'], 
-               index=['entry'], columns=['tcharge'])
-        dat_goods.columns = ['_'.join(map(lambda x: str(x), col)) for col in dat_goods.columns]
-        dat_goods.drop(['ksalign_n', 'ksminv_n', 'ksptot_n', 'ksdpsi_n', 'ksz0_n', 'kslen_n', 'ksth_n', 'ksphi_n'], axis=1, inplace=True)
+        if engine == 'awkward':
+            dat_goods = self._pair_awkward(entry_start, entry_stop)
+        else:
+            dat_goods = self._pair_pandas(entry_start, entry_stop)
+        if len(dat_goods) == 0:
+            return pd.DataFrame()
+        dat_glob = self.get_dat_glob(entry_start, entry_stop)
         
         #kick badruns
         dat_glob = dat_glob.query('badrun==False')
@@ -132,19 +227,11 @@ class Handler:
         dat_goods['x1'], dat_goods['x2'] = get_x(dat_goods)
         
         #calc recoil mass
-        vec = vector.array({
-            'pt' : dat_goods['ksptot']*np.sin(dat_goods['ksth']),
-            'theta' : dat_goods['ksth'],
-            'phi' : dat_goods['ksphi'],
-            'mass' : dat_goods['ksminv'],
-        })
-        vec0 = vector.obj(px=0, py=0, pz=0, E=dat_goods['emeas'].mean()*2)
-        dat_goods['recoil'] = (vec0 - vec).mass
-        del vec
+        dat_goods['recoil'] = Handler.recoil_mass(dat_goods, emeas)
         
         #add photons
         if photons is not None:
-            dat_photons = self.get_dat_photons()
+            dat_photons = self.get_dat_photons(entry_start, entry_stop, best=(photons == 'one'))
             dat_goods = pd.merge(dat_goods.reset_index(), dat_photons.reset_index(), on='entry', how='left')
             dat_goods['subentry'] = dat_goods['subentry'].fillna(0).astype(int)
             dat_goods = dat_goods.set_index(['entry', 'subentry'])
@@ -152,82 +239,301 @@ class Handler:
                 dat_goods = dat_goods.sort_values('M', ascending=True, key=lambda x: np.abs(x-134.97)).groupby('entry').agg('first')
         
         return dat_goods
-    def get_dat_photons(self):
-        arrs = self.tree.arrays(['pt', 'theta', 'phi', 'mass'], cut='(nt>=2)&(nks>0)&(phen>0)', aliases={'pt': 'phen*sin(phth)', 'theta': 'phth', 
-                                                                          'phi': 'phphi', 'mass': '0*phen'})
-        vecs = vector.Array(arrs)
-
-        df = ak.to_pandas(ak.combinations(vecs.px, 2))
-        df = df.rename({ '0' : 'px0', '1' : 'px1'}, axis=1)
-        df_len = len(df)
-
-        df = df.join( ak.to_pandas(ak.combinations(vecs.py, 2)) )
-        assert df_len == len(df)
-        df_len = len(df)
-        df = df.rename({ '0' : 'py0', '1' : 'py1'}, axis=1)
+    def _pair_pandas(self, entry_start=None, entry_stop=None):
+        dat_tracks = self.get_dat_tracks(entry_start, entry_stop)
+        dat_kaons = self.get_dat_kaons(entry_start, entry_stop)
 
-        df = df.join( ak.to_pandas(ak.combinations(vecs.pz, 2)) )
-        assert df_len == len(df)
-        df_len = len(df)
-        df = df.rename({ '0' : 'pz0', '1' : 'pz1'}, axis=1)
-
-        df = df.join( ak.to_pandas(ak.combinations(vecs.E, 2)) )
-        assert df_len == len(df)
-        df_len = len(df)
-        df = df.rename({ '0' : 'E0', '1' : 'E1'}, axis=1)
+        dat_goods = dat_tracks.join(dat_kaons, how='inner')
+        goods = dat_goods.groupby('entry').agg(num=('tz', 'count')).query('num==2').index
+        dat_goods = dat_goods.reset_index().set_index('entry').loc[goods].reset_index().set_index(['entry', 'subentry'])
+        if len(dat_goods) == 0:
+            return pd.DataFrame()
 
+        dat_goods['tcharge'] = np.where(dat_goods['tcharge']>0, 'p', 'n')
+        dat_goods = pd.pivot_table(dat_goods.reset_index(), values=self.tracks_values + self.kaons_values, 
+               index=['entry'], columns=['tcharge'])
+        dat_goods.columns = ['_'.join(map(lambda x: str(x), col)) for col in dat_goods.columns]
+        dat_goods.drop([f'{v}_n' for v in self.kaons_values], axis=1, inplace=True)
+        return dat_goods
+    def _pair_awkward(self, entry_start=None, entry_stop=None):
+        """
+        Сопоставить пару треков с лучшим по массе каоном прямо на jagged-массивах: 
+        отбор событий с 2 треками нулевого суммарного заряда, выбор каона с минимальным |ksminv - mKs| 
+        и разбиение по знаку заряда делаются в awkward/numpy, в pd.DataFrame переводится только результат 
+        (те же колонки и значения, что и после `pivot_table` в `_pair_pandas`)
+        """
+        tracks = self._arrays_tracks(entry_start, entry_stop)
+        kaons = self._arrays_kaons(entry_start, entry_stop)
+        entries = np.arange(len(tracks)) + (entry_start or 0)
+        
+        events = (ak.num(tracks['tz'])==2)&(ak.sum(tracks['tcharge'], axis=1)==0)&(ak.num(kaons['dlt_mass'])>0)
+        events = ak.to_numpy(events)
+        if not events.any():
+            return pd.DataFrame()
+        tracks, kaons, entries = tracks[events], kaons[events], entries[events]
+        best = ak.argmin(kaons['dlt_mass'], axis=1, keepdims=True)
+        rows = ak.to_numpy(ak.flatten(kaons['ksvind'][best], axis=1))[:, :2].astype(np.int64)
+        
+        #оба трека каона должны быть среди двух отобранных треков
+        goods = ((rows>=0)&(rows<2)).all(axis=1)
+        if not goods.any():
+            return pd.DataFrame()
+        rows, entries = rows[goods], entries[goods]
+        take = lambda arr: np.take_along_axis(ak.to_numpy(arr[goods]), rows, axis=1)
+        positive = take(tracks['tcharge'])>0
+        
+        columns = {}
+        for value in sorted(self.tracks_values + self.kaons_values):
+            if value in self.kaons_values:
+                vals = ak.to_numpy(ak.flatten(kaons[value][best], axis=1))[goods]
+                columns[f'{value}_p'] = _charge_means(np.repeat(vals[:, None], 2, axis=1), positive, ~positive)[0]
+            else:
+                columns[f'{value}_n'], columns[f'{value}_p'] = _charge_means(take(tracks[value]), ~positive, positive)
+        return pd.DataFrame(columns, index=pd.Index(entries, name='entry'))
+    def recoil_mass(dat: pd.DataFrame, emeas: Optional[float] = None) -> np.ndarray:
+        """
+        Масса отдачи каона (колонки ksptot, ksth, ksphi, ksminv) при энергии пучка emeas 
+        (None -- среднее emeas по событиям dat, каждое событие учитывается один раз)
+        """
+        vec = vector.array({
+            'pt' : dat['ksptot']*np.sin(dat['ksth']),
+            'theta' : dat['ksth'],
+            'phi' : dat['ksphi'],
+            'mass' : dat['ksminv'],
+        })
+        if emeas is None:
+            emeas = dat['emeas'].groupby(level='entry', sort=False).first().mean()
+        vec0 = vector.obj(px=0, py=0, pz=0, E=emeas*2)
+        return (vec0 - vec).mass
+    def iterate_good_kaons(self, step_size='100 MB', photons='one', engine='pandas', emeas=None):
+        """
+        Обрабатывать дерево порциями: каждая порция проходит через `get_good_kaons` целиком, 
+        так что потребление памяти определяется размером порции, а не файла. 
+        Чтобы масса отдачи во всех порциях считалась с одной энергией, её нужно передать в emeas, 
+        иначе в каждой порции берётся своё среднее emeas (`get_good_kaons_chunked` пересчитывает recoil по всему файлу)
+        
+        Parameters
+        ----------
+        step_size : Union[int, str]
+            размер порции в событиях (int) или в памяти на все нужные ветки (str, например '100 MB'), как в `uproot.iterate`
+        photons : Optional[str]
+            см. `get_good_kaons`
+        engine : str
+            см. `get_good_kaons`
+        emeas : Optional[float]
+            энергия пучка для массы отдачи, None -- среднее emeas порции
+        
+        Yields
+        ------
+        pd.DataFrame
+            отобранные события порции (номера событий `entry` -- номера в дереве)
+        """
+        
+        if isinstance(step_size, str):
+            step_size = max(1, self.tree.num_entries_for(step_size, self.branches))
+        num_entries = self.tree.num_entries
+        for entry_start in range(0, num_entries, step_size):
+            entry_stop = min(entry_start + step_size, num_entries)
+            yield self.get_good_kaons(photons, entry_start, entry_stop, engine, emeas)
+    def get_good_kaons_chunked(self, step_size='100 MB', photons='one', engine='pandas', emeas=None):
+        """
+        То же, что `get_good_kaons`, но с чтением дерева порциями (см. `iterate_good_kaons`); 
+        без emeas масса отдачи пересчитывается на объединённых порциях со средним emeas по всему файлу
+        """
+        
+        dats = [dat for dat in self.iterate_good_kaons(step_size, photons, engine, emeas) if len(dat) > 0]
+        if len(dats) == 0:
+            return pd.DataFrame()
+        dat_goods = pd.concat(dats)
+        if emeas is None:
+            dat_goods['recoil'] = Handler.recoil_mass(dat_goods)
+        return dat_goods
+    def get_dat_photons(self, entry_start=None, entry_stop=None, best=False):
+        """
+        Пары фотонов из калориметра: импульсы, энергии и инвариантная масса пары `M`.
+        Пары строятся одним `ak.combinations` по записям (px, py, pz, E), масса считается векторно на массивах
+        best - оставить в каждом событии только пару с массой, ближайшей к массе pi0 (subentry тогда 0)
+        """
+        arrs = self.tree.arrays(['pt', 'theta', 'phi', 'mass'], cut='(nt>=2)&(nks>0)&(phen>0)', aliases={'pt': 'phen*sin(phth)', 'theta': 'phth', 
+                                                                          'phi': 'phphi', 'mass': '0*phen'}, entry_start=entry_start, entry_stop=entry_stop)
+        vecs = vector.Array(arrs)
+        photons = ak.zip({'px': vecs.px, 'py': vecs.py, 'pz': vecs.pz, 'E': vecs.E})
+        g0, g1 = ak.unzip(ak.combinations(photons, 2))
+        
+        pairs = {}
+        for coord in ('px', 'py', 'pz', 'E'):
+            pairs[f'{coord}0'], pairs[f'{coord}1'] = g0[coord], g1[coord]
         for coord in ('x', 'y', 'z'):
-            df[f'P{coord}'] = df[f'p{coord}0'] + df[f'p{coord}1']
-        df['P'] = np.sqrt( df['Px']**2 + df['Py']**2 + df['Pz']**2 )
-        df['E'] = df['E0'] + df['E1']
-        M2 = df['E']**2 - df['P']**2
-        df['M'] = np.where(M2>0, np.sqrt( np.abs(M2) ), -np.sqrt( np.abs(M2) ))
-        return df
-    def get_dat_glob(self):
+            pairs[f'P{coord}'] = g0[f'p{coord}'] + g1[f'p{coord}']
+        pairs['P'] = np.sqrt( np.square(pairs['Px']) + np.square(pairs['Py']) + np.square(pairs['Pz']) )
+        pairs['E'] = g0['E'] + g1['E']
+        M2 = np.square(pairs['E']) - np.square(pairs['P'])
+        pairs['M'] = ak.where(M2>0, np.sqrt( np.abs(M2) ), -np.sqrt( np.abs(M2) ))
+        pairs = ak.zip(pairs)
+        
+        if best:
+            pairs = pairs[ak.singletons(ak.argmin(np.abs(pairs['M'] - 134.97), axis=1))]
+        return _to_pandas(pairs, entry_start)
+    def get_dat_glob(self, entry_start=None, entry_stop=None):
         """
         Работа с глобальными переменными и поиск `badruns`
         """
-        dat_glob = ak.to_pandas(self.tree.arrays(['ebeam', 'emeas', 'lumoff', 'lumofferr', 'runnum', 'finalstate_id', 'trigbits']))
-        badruns = np.loadtxt('pylib/badruns.dat')
-        dat_glob['badrun'] = dat_glob.runnum.isin(badruns)
-        return dat_glob
+        dat_glob = _to_pandas(self.tree.arrays(['ebeam', 'emeas', 'lumoff', 'lumofferr', 'runnum', 'finalstate_id', 'trigbits'],
+                                               entry_start=entry_start, entry_stop=entry_stop), entry_start)
+        return _mark_badruns(dat_glob)
     
 class HandlerKSKS:
-    def __init__(self, tree, cut_dedx=2500, cut_z=12, cut_align=0.8):
+    tracks_branches = ['tz', 'tptot', 'tdedx', 'tcharge', 'trho', 'tth', 'tphi']
+    kaons_branches = ['ksptot', 'ksminv', 'ksalign', 'dlt_mass', 'ksvind', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi']
+    glob_branches = ['ebeam', 'emeas', 'lumoff', 'lumofferr', 'runnum', 'finalstate_id', 'trigbits']
+    tracks_values = ['tz', 'trho', 'tdedx', 'tth', 'tphi']
+    kaons_values = ['ksptot', 'ksminv', 'ksalign', 'dlt_mass', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi', 
+                    'ebeam', 'emeas', 'lumoff', 'lumofferr', 'runnum', 'finalstate_id', 'trigbits', 'badrun']
+    
+    def __init__(self, tree, cut_dedx=2500, cut_z=12, cut_align=0.8, fused=False, step_size='100 MB'):
         """
         Поиск KSKS
+        fused - читать ветки треков, каонов и глобальных переменных за один проход по дереву (см. `get_dat_fused`)
+        step_size - размер порции чтения в режиме fused (как в `uproot.iterate`)
         """
         self.tree = tree
         self.cut_dedx = cut_dedx
         self.cut_z = cut_z
         self.cut_align = cut_align
-    def get_dat_tracks(self):
-        e0 = self.tree['emeas'].array()[0]
+        self.fused = fused
+        self.step_size = step_size
+        self.read_stats = None
+    def _arrays_tracks(self):
+        e0 = self.tree['emeas'].array(entry_stop=1)[0]
         pidedx = '5.58030e+9 / (tptot + 40.)**3 + 2.21228e+3 - 3.77103e-1 * tptot - tdedx'
-        arrs = self.tree.arrays(['tz', 'tptot', 'tdedx', 'tcharge', 'trho', 'tth', 'tphi'], 
+        return self.tree.arrays(self.tracks_branches, 
                          f'(nt>=4)&(nks==2)&(tnhit>6)&(abs(pidedx)<{self.cut_dedx})&(tchi2r<20)&(tchi2z<20)&(abs(tz)<{self.cut_z})&(tptot<{e0})&(tptot>40)', 
                          aliases={'pidedx': pidedx})
-        dat_tracks = ak.to_pandas(arrs)
+    def _arrays_kaons(self):
+        dlt_mass = 'abs(ksminv-497.6)'
+        cuts = f'(nt>=4)&(nks==2)&(ksalign>{self.cut_align})&(dlt_mass<200)'
+        return self.tree.arrays(self.kaons_branches, cuts, aliases={'dlt_mass': dlt_mass})
+    def get_dat_tracks(self):
+        return HandlerKSKS._select_tracks(ak.to_pandas(self._arrays_tracks()))
+    def _select_tracks(dat_tracks):
+        """
+        Оставить события ровно с 4 хорошими треками и нулевым суммарным зарядом
+        """
         dat_tracks_groups = dat_tracks.groupby('entry').agg(uniques=('tz', 'count'), charge=('tcharge', 'sum'))
         idx = dat_tracks_groups.query('(uniques==4)&(charge==0)').index
         dat_tracks = dat_tracks.loc[idx]
         dat_tracks.index.rename(['entry', 'ksvind'], inplace=True)
         return dat_tracks
     def get_dat_kaons(self):
-        dlt_mass = 'abs(ksminv-497.6)'
-        cuts = f'(nt>=4)&(nks==2)&(ksalign>{self.cut_align})&(dlt_mass<200)'
-        dat_kaons = ak.to_pandas(self.tree.arrays(['ksptot', 'ksminv', 'ksalign', 'dlt_mass', 'ksvind', 'ksdpsi', 'ksz0', 'kslen', 'ksth', 'ksphi'], 
-                           cuts, aliases={'dlt_mass': dlt_mass})).loc[:, :, :1]
-        
+        return HandlerKSKS._select_kaons(ak.to_pandas(self._arrays_kaons()))
+    def _select_kaons(dat_kaons):
+        """
+        Оставить события с двумя каонами, построенными на 4 разных треках
+        """
+        dat_kaons = dat_kaons.loc[:, :, :1]
         idx2kaons = dat_kaons.groupby('entry').agg(n=('ksvind', 'nunique')).query('n==4').index
         dat_kaons = dat_kaons.loc[idx2kaons]
         return dat_kaons.reset_index().set_index(['entry', 'subentry', 'ksvind']).drop(['subsubentry'], axis=1)
-    def get_good_kaons(self, photons='one'):
+    def _fused_ranges(self) -> List[Tuple[int, int]]:
+        """
+        Диапазоны событий (entry_start, entry_stop) для чтения в режиме fused: сначала читаются только nt, nks, 
+        и остаются лишь промежутки между общими границами корзин (`common_entry_offsets`), где есть события с nt>=4, nks==2, 
+        так что корзины остальных веток без таких событий не читаются. Соседние промежутки объединяются в порции 
+        не больше `step_size`
+        """
+        
+        selected = (self.tree['nt'].array(library='np')>=4)&(self.tree['nks'].array(library='np')==2)
+        offsets = np.asarray(self.tree.common_entry_offsets())
+        n_selected = np.add.reduceat(selected, offsets[:-1]) if len(selected) > 0 else np.zeros(0, dtype=int)
+        step = max(self.tree.num_entries_for(self.step_size), 1) if isinstance(self.step_size, str) else self.step_size
+        ranges = []
+        for start, stop, n in zip(offsets[:-1], offsets[1:], n_selected):
+            if n == 0:
+                continue
+            if len(ranges) > 0 and ranges[-1][1] == start and stop - ranges[-1][0] <= step:
+                ranges[-1] = (ranges[-1][0], int(stop))
+            else:
+                ranges.append((int(start), int(stop)))
+        return ranges
+    def _fused_arrays(self):
+        """
+        Генератор по порциям дерева (см. `_fused_ranges`): объединение веток читается один раз на каждую порцию, 
+        а отборы `get_dat_tracks`, `get_dat_kaons` применяются к общим массивам в памяти
+        
+        Yields
+        ------
+        Tuple[ak.Array, ak.Array, ak.Array, np.ndarray]
+            треки, каоны и глобальные переменные событий порции с nt>=4, nks==2 и номера этих событий в дереве
+        """
+        
+        branches = set(self.tracks_branches + self.kaons_branches + self.glob_branches)
+        branches = sorted((branches - {'dlt_mass'}) | {'nt', 'nks', 'tnhit', 'tchi2r', 'tchi2z'})
+        e0 = self.tree['emeas'].array(entry_stop=1)[0]
+        for entry_start, entry_stop in self._fused_ranges():
+            arrs = self.tree.arrays(branches, entry_start=entry_start, entry_stop=entry_stop)
+            entries = np.arange(entry_start, entry_stop)
+            events = ak.to_numpy((arrs['nt']>=4)&(arrs['nks']==2))
+            arrs, entries = arrs[events], entries[events]
+            
+            pidedx = 5.58030e+9 / (arrs['tptot'] + 40.)**3 + 2.21228e+3 - 3.77103e-1 * arrs['tptot'] - arrs['tdedx']
+            cut_tracks = (arrs['tnhit']>6)&(np.abs(pidedx)<self.cut_dedx)&(arrs['tchi2r']<20)&(arrs['tchi2z']<20)&\
+                (np.abs(arrs['tz'])<self.cut_z)&(arrs['tptot']<e0)&(arrs['tptot']>40)
+            tracks = ak.zip({b: arrs[b][cut_tracks] for b in self.tracks_branches}, depth_limit=1)
+            
+            dlt_mass = np.abs(arrs['ksminv'] - 497.6)
+            cut_kaons = (arrs['ksalign']>self.cut_align)&(dlt_mass<200)
+            kaons = ak.zip({b: (dlt_mass if b=='dlt_mass' else arrs[b])[cut_kaons] for b in self.kaons_branches}, depth_limit=1)
+            
+            glob = ak.zip({b: arrs[b] for b in self.glob_branches})
+            yield tracks, kaons, glob, entries
+    def get_dat_fused(self):
+        """
+        Прочитать ветки треков, каонов и глобальных переменных за один проход по дереву (см. `_fused_arrays`)
+        
+        Returns
+        -------
+        Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]
+            dat_tracks, dat_kaons, dat_glob (dat_glob только для событий с nt>=4, nks==2)
+        """
+        
+        tracks, kaons, globs = [], [], []
+        for arr_tracks, arr_kaons, arr_glob, entries in self._fused_arrays():
+            tracks.append(_shift_entries(ak.to_pandas(arr_tracks), entries))
+            kaons.append(_shift_entries(ak.to_pandas(arr_kaons), entries))
+            globs.append(_shift_entries(ak.to_pandas(arr_glob), entries))
+        
+        dat_tracks = HandlerKSKS._select_tracks(pd.concat(tracks))
+        dat_kaons = HandlerKSKS._select_kaons(pd.concat(kaons))
+        dat_glob = _mark_badruns(pd.concat(globs))
+        return dat_tracks, dat_kaons, dat_glob
+    def get_good_kaons(self, photons='one', engine='pandas'):
         """
+        engine : 'pandas', 'awkward' -- как сопоставлять треки с каонами: через join/pivot в pandas 
+        или прямо на jagged-массивах (см. `_pair_awkward`), результат одинаковый
+        В `read_stats` сохраняется объём прочитанных из файла байт ('bytes_read') и время чтения ('wall_time', с)
         """
-        dat_tracks = self.get_dat_tracks()
-        dat_kaons = self.get_dat_kaons()
-        dat_glob = self.get_dat_glob()
+        source = self.tree.file.source
+        bytes0, time0 = source.num_requested_bytes, time.perf_counter()
+        if engine == 'awkward':
+            if self.fused:
+                chunks = list(self._fused_arrays())
+            else:
+                chunks = [(self._arrays_tracks(), self._arrays_kaons(), self.tree.arrays(self.glob_branches), 
+                           np.arange(self.tree.num_entries))]
+        elif self.fused:
+            dat_tracks, dat_kaons, dat_glob = self.get_dat_fused()
+        else:
+            dat_tracks = self.get_dat_tracks()
+            dat_kaons = self.get_dat_kaons()
+            dat_glob = self.get_dat_glob()
+        self.read_stats = {
+            'bytes_read': source.num_requested_bytes - bytes0, 
+            'wall_time': time.perf_counter() - time0,
+        }
+        
+        if engine == 'awkward':
+            dats = [HandlerKSKS._pair_awkward(*chunk) for chunk in chunks]
+            return pd.concat([dat for dat in dats if len(dat) > 0] or dats[:1])
 
         dat_goods = dat_tracks.join(dat_kaons, how='inner')
         
@@ -238,25 +544,66 @@ class HandlerKSKS:
         
         #pivot
         dat1 = pd.pivot_table(
-            dat_goods, values=['tz', 'trho', 'tdedx', 'tth', 'tphi'],
+            dat_goods, values=HandlerKSKS.tracks_values,
             index=['entry', 'subentry'],
             columns=['tcharge']
         )
         dat1.columns = ['_'.join(map(lambda x: str(x), col)) for col in dat1.columns]
-        dat2 = dat_goods.reset_index().drop_duplicates(subset=['entry', 'subentry']).set_index(['entry', 'subentry'])[['ksptot',
-       'ksminv', 'ksalign', 'dlt_mass', 'ksdpsi', 'ksz0', 'kslen', 'ksth',
-       'ksphi', 'ebeam', 'emeas', 'lumoff', 'lumofferr', 'runnum',
-       'finalstate_id', 'trigbits', 'badrun']]
+        dat2 = dat_goods.reset_index().drop_duplicates(subset=['entry', 'subentry']).set_index(['entry', 'subentry'])[HandlerKSKS.kaons_values]
         dat1 = dat1.join(dat2)
         return dat1
+    def _pair_awkward(tracks, kaons, glob, entries):
+        """
+        Сопоставить треки с двумя каонами прямо на jagged-массивах: отбор событий с 4 треками нулевого 
+        суммарного заряда и двумя каонами на 4 разных треках, разбиение треков каона по знаку заряда -- в awkward/numpy, 
+        в pd.DataFrame переводится только результат (те же колонки и значения, что и в движке 'pandas')
+        
+        Parameters
+        ----------
+        tracks, kaons, glob : ak.Array
+            треки, каоны и глобальные переменные после отборов `get_dat_tracks`, `get_dat_kaons`
+        entries : np.ndarray
+            номера событий массивов в дереве
+        """
+        
+        empty = pd.DataFrame(columns=[f'{v}_{c}' for v in sorted(HandlerKSKS.tracks_values) for c in 'np'] + HandlerKSKS.kaons_values)
+        events = (ak.num(tracks['tz'])==4)&(ak.sum(tracks['tcharge'], axis=1)==0)&(ak.num(kaons['ksminv'])==2)
+        events = ak.to_numpy(events) & ~np.isin(ak.to_numpy(glob['runnum']), _badruns())
+        if not events.any():
+            return empty
+        ksvind = ak.to_numpy(kaons['ksvind'][events])[:, :, :2].astype(np.int64)
+        flat = np.sort(ksvind.reshape(len(ksvind), -1), axis=1)
+        goods = (np.diff(flat, axis=1)!=0).all(axis=1)
+        if not goods.any():
+            return empty
+        events[events] = goods
+        rows = ksvind[goods]
+        
+        #строки join: трек каона, если он есть среди 4 отобранных треков
+        valid = (rows>=0)&(rows<4)
+        rows = np.where(valid, rows, 0)
+        take = lambda arr: ak.to_numpy(arr[events])[np.arange(len(rows))[:, None, None], rows]
+        positive = take(tracks['tcharge'])>0
+        
+        columns = {}
+        for value in sorted(HandlerKSKS.tracks_values):
+            columns[f'{value}_n'], columns[f'{value}_p'] = _charge_means(take(tracks[value]), valid&~positive, valid&positive)
+        for value in HandlerKSKS.kaons_values:
+            if value == 'badrun':
+                columns[value] = np.zeros(rows.shape[:2], dtype=bool)
+            elif value in HandlerKSKS.glob_branches:
+                columns[value] = np.repeat(ak.to_numpy(glob[value][events])[:, None], 2, axis=1)
+            else:
+                columns[value] = ak.to_numpy(kaons[value][events])
+        index = pd.MultiIndex.from_product([entries[events], [0, 1]], names=['entry', 'subentry'])
+        dat = pd.DataFrame({k: v.ravel() for k, v in columns.items()}, index=index)
+        return dat[valid.any(axis=2).ravel()]
     def get_dat_glob(self):
         """
         Работа с глобальными переменными и поиск `badruns`
         """
-        dat_glob = ak.to_pandas(self.tree.arrays(['ebeam', 'emeas', 'lumoff', 'lumofferr', 'runnum', 'finalstate_id', 'trigbits']))
-        badruns = np.loadtxt('pylib/badruns.dat')
-        dat_glob['badrun'] = dat_glob.runnum.isin(badruns)
-        return dat_glob
+        dat_glob = ak.to_pandas(self.tree.arrays(self.glob_branches))
+        return _mark_badruns(dat_glob)
     def collinear_cut(df, col_th=0.25, col_phi=0.15, plot=False, return_pivot=False):
         """
         Кат на коллинеарность каонов: 0.25 по тета, 0.15 по фи
@@ -364,4 +711,230 @@ class HandlerKSKS:
         """
         idx = df.loc[(df.ksminv - 497.6) < cut_mass ].reset_index().groupby('entry').agg({'subentry': 'count'}).query('subentry==2').index
         return df.loc[idx]
-        
\ No newline at end of file
+        
+def kaon_pairs(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Перевести события с двумя каонами из pd.DataFrame с индексом (entry, subentry) в массивы (событие x каон)
+    
+    Parameters
+    ----------
+    df : pd.DataFrame
+        каоны, subentry - номер каона в событии (0 или 1)
+    
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, dict]
+        номера событий (entry, по возрастанию), номер события в этом списке для каждой строки df 
+        и {колонка: массив (n_events, 2)} (NaN, если каона с таким subentry в событии нет)
+    """
+    
+    entry = df.index.get_level_values(0).values
+    sub = df.index.get_level_values(1).values
+    if not np.isin(sub, (0, 1)).all():
+        raise ValueError('subentry must be 0 or 1')
+    entries, inverse = np.unique(entry, return_inverse=True)
+    columns = {}
+    for column in df.columns:
+        values = np.full((len(entries), 2), np.nan)
+        values[inverse, sub] = df[column].values
+        columns[column] = values
+    return entries, inverse, columns
+
+def kaon_cut_variable(kaons: dict, threshold: str, emeas: Optional[float] = None) -> np.ndarray:
+    """
+    Переменная события, с которой сравнивается порог `threshold` в катах `HandlerKSKS` 
+    (NaN, если для неё нужны оба каона, а в событии он один)
+    
+    Parameters
+    ----------
+    kaons : dict
+        {колонка: массив (n_events, 2)} из `kaon_pairs`
+    threshold : str
+        'col_th', 'col_phi' - отклонения от коллинеарности по тета и фи, 
+        'cut_en' - отклонение полной энергии каонов от 2*emeas, 'cut_mom' - наибольшее отклонение импульса каона от ожидаемого,
+        'cut_flight' - наименьший отлёт, 'cut_mass' - наибольшее (со знаком) отклонение инв. массы от 497.6 МэВ
+    emeas : Optional[float]
+        энергия пучка для 'cut_en', 'cut_mom'
+    
+    Returns
+    -------
+    np.ndarray
+        значения переменной для каждого события
+    """
+    
+    present = ~np.isnan(kaons['emeas'])
+    #первый и последний каон события (у события с одним каоном это один и тот же каон)
+    first = lambda x: np.where(present[:, 0], x[:, 0], x[:, 1])
+    last = lambda x: np.where(present[:, 1], x[:, 1], x[:, 0])
+    if threshold == 'col_th':
+        return np.abs(first(kaons['ksth']) + last(kaons['ksth']) - np.pi)
+    if threshold == 'col_phi':
+        return np.abs(np.abs(last(kaons['ksphi']) - first(kaons['ksphi'])) - np.pi)
+    if threshold == 'cut_en':
+        ksptot, ksminv = kaons['ksptot'], kaons['ksminv']
+        total_en = np.sqrt(ksptot[:, 0]**2 + ksminv[:, 1]**2) + np.sqrt(ksptot[:, 1]**2 + ksminv[:, 1]**2)
+        return np.abs(total_en - 2*emeas)
+    if threshold == 'cut_mom':
+        return np.max(np.abs(kaons['ksptot'] - np.sqrt(emeas**2 - 497.6**2)), axis=1)
+    if threshold == 'cut_flight':
+        return np.min(kaons['kslen'], axis=1)
+    if threshold == 'cut_mass':
+        return np.max(kaons['ksminv'] - 497.6, axis=1)
+    raise ValueError(f'Unknown threshold: {threshold}')
+
+class KSKSCutChain:
+    """
+    Каты `HandlerKSKS` (collinear_cut, sum_energy_cut, kaon_mom_cut, flight_cut, ksminv_cut) за один проход: 
+    каоны один раз переводятся в массивы (событие x каон) (см. `kaon_pairs`), каты считаются как маски событий
+    (с теми же порогами и формулами, что и у методов `HandlerKSKS`), None - не применять кат
+    
+    emeas - энергия пучка для 'cut_en', 'cut_mom'; None - как в `HandlerKSKS`: средняя по каонам событий, 
+    прошедших предыдущие каты
+    """
+    cuts = ['collinear', 'sum_energy', 'kaon_mom', 'flight', 'ksminv']
+    columns = ['ksth', 'ksphi', 'ksptot', 'ksminv', 'kslen', 'emeas']
+    # пороги каждого ката
+    thresholds = {
+        'collinear': ['col_th', 'col_phi'],
+        'sum_energy': ['cut_en'],
+        'kaon_mom': ['cut_mom'],
+        'flight': ['cut_flight'],
+        'ksminv': ['cut_mass'],
+    }
+    # пороги, которые переменная должна превышать (остальные - быть меньше порога)
+    lower_thresholds = ['cut_flight']
+    
+    def __init__(self, col_th=0.25, col_phi=0.15, cut_en=100, cut_mom=60, cut_flight=0.1, cut_mass=25, emeas=None):
+        self.col_th = col_th
+        self.col_phi = col_phi
+        self.cut_en = cut_en
+        self.cut_mom = cut_mom
+        self.cut_flight = cut_flight
+        self.cut_mass = cut_mass
+        self.emeas = emeas
+    def masks(self, kaons: dict) -> dict:
+        """
+        Маски событий после каждого применённого ката (с учётом предыдущих)
+        
+        Parameters
+        ----------
+        kaons : dict
+            {колонка: массив (n_events, 2)} из `kaon_pairs`
+        
+        Returns
+        -------
+        dict
+            {кат: маска событий}, в порядке `cuts`
+        """
+        
+        present = ~np.isnan(kaons['emeas'])
+        mask = present.any(axis=1)
+        masks = {}
+        for cut, thresholds in self.thresholds.items():
+            if all(getattr(self, t) is None for t in thresholds):
+                continue
+            #средняя энергия по строкам (каонам) событий, прошедших предыдущие каты
+            emeas = self.emeas
+            if (emeas is None) and (cut in ('sum_energy', 'kaon_mom')):
+                emeas = kaons['emeas'][present & mask[:, None]].mean()
+            for t in thresholds:
+                if getattr(self, t) is not None:
+                    mask = mask & KSKSCutChain.passed(t, kaon_cut_variable(kaons, t, emeas), getattr(self, t))
+            masks[cut] = mask
+        return masks
+    def passed(threshold: str, variable: np.ndarray, value: float) -> np.ndarray:
+        """Маска событий, у которых переменная `kaon_cut_variable` проходит порог `threshold` = value"""
+        return (variable > value) if threshold in KSKSCutChain.lower_thresholds else (variable < value)
+    def apply(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Применить каты к каонам df (индекс (entry, subentry))
+        
+        Returns
+        -------
+        Tuple[pd.DataFrame, pd.DataFrame]
+            строки событий, прошедших все каты (в исходном порядке), 
+            и cutflow: число событий ('events') после каждого ката и доля ('eff') от предыдущего шага
+        """
+        
+        entries, inverse, kaons = kaon_pairs(df[self.columns])
+        masks = self.masks(kaons)
+        mask = masks[list(masks)[-1]] if len(masks) > 0 else np.ones(len(entries), dtype=bool)
+        
+        events = [len(entries)] + [int(m.sum()) for m in masks.values()]
+        cutflow = pd.DataFrame({'events': events}, index=pd.Index(['all'] + list(masks), name='cut'))
+        cutflow['eff'] = cutflow['events']/cutflow['events'].shift(1)
+        return df[mask[inverse]], cutflow
+
+class KSKSCutScan:
+    """
+    Скан порогов катов `KSKSCutChain`: переменные катов (`kaon_cut_variable`) считаются для событий один раз, 
+    а числа прошедших событий для всех комбинаций порогов сетки - одной многомерной гистограммой по номерам порогов 
+    и кумулятивными суммами по её осям
+    
+    Энергия пучка в 'cut_en', 'cut_mom' одна на весь скан (`self.emeas`, по умолчанию - средняя по всем каонам df), 
+    и с ней же считаются каты `KSKSCutChain` в `counts`, так что числа событий совпадают с `KSKSCutChain(emeas=self.emeas)`. 
+    `KSKSCutChain()` без emeas усредняет энергию только по прошедшим предыдущие каты, поэтому при разбросе emeas 
+    результат может немного отличаться
+    """
+    
+    def __init__(self, df: pd.DataFrame, signal: Optional[str] = None, emeas: Optional[float] = None):
+        """
+        df - каоны с индексом (entry, subentry)
+        signal - условие на строки df для сигнальных событий (например, 'finalstate_id==8'), 
+        событие сигнальное, если условию удовлетворяет хотя бы один его каон
+        emeas - энергия пучка для 'cut_en', 'cut_mom' (None - средняя по всем каонам df)
+        """
+        entries, inverse, kaons = kaon_pairs(df[KSKSCutChain.columns])
+        self.emeas = np.nanmean(kaons['emeas']) if emeas is None else emeas
+        thresholds = sum(KSKSCutChain.thresholds.values(), [])
+        self.variables = pd.DataFrame({t: kaon_cut_variable(kaons, t, self.emeas) for t in thresholds}, index=pd.Index(entries, name='entry'))
+        self.signal = None
+        if signal is not None:
+            self.signal = np.bincount(inverse, weights=df.eval(signal).values.astype(float), minlength=len(entries)) > 0
+    def counts(self, grid: dict, fixed: Optional[dict] = None) -> pd.DataFrame:
+        """
+        Число событий, прошедших каты, для всех комбинаций порогов
+        
+        Parameters
+        ----------
+        grid : dict
+            {порог (как в `KSKSCutChain`): значения}
+        fixed : Optional[dict]
+            значения порогов не из grid (None - не применять кат), по умолчанию - как в `KSKSCutChain()`;
+            энергия пучка всегда `self.emeas`
+        
+        Returns
+        -------
+        pd.DataFrame
+            индекс - комбинации порогов (только тех, что применяются), колонки 'events' 
+            (и 'signal', 'background', если задан signal)
+        """
+        
+        chain = KSKSCutChain(**(fixed if fixed is not None else {}), emeas=self.emeas)
+        axes = {}
+        for t in self.variables.columns:
+            values = np.atleast_1d(grid[t]) if t in grid else [getattr(chain, t)]
+            if values[0] is not None:
+                #пороги по возрастанию "мягкости": событие, прошедшее порог, проходит и все следующие
+                axes[t] = np.sort(values)[::-1] if t in KSKSCutChain.lower_thresholds else np.sort(values)
+        
+        shape = tuple(len(v) for v in axes.values())
+        index = np.zeros((len(axes), len(self.variables)), dtype=np.int64)
+        for i, (t, values) in enumerate(axes.items()):
+            sign = -1 if t in KSKSCutChain.lower_thresholds else 1
+            #номер первого пройденного порога (len(values) - не прошло ни одного, в том числе NaN)
+            index[i] = np.searchsorted(sign*values, sign*self.variables[t].values, side='right')
+        keep = (index < np.array(shape)[:, None]).all(axis=0)
+        flat = np.ravel_multi_index(index[:, keep], shape)
+        
+        def cumulative(weights=None):
+            hist = np.bincount(flat, weights=weights, minlength=int(np.prod(shape))).reshape(shape)
+            for axis in range(len(shape)):
+                hist = np.cumsum(hist, axis=axis)
+            return hist.ravel().astype(np.int64)
+        
+        result = pd.DataFrame({'events': cumulative()}, index=pd.MultiIndex.from_product(list(axes.values()), names=list(axes)))
+        if self.signal is not None:
+            result['signal'] = cumulative(self.signal[keep].astype(float))
+            result['background'] = result['events'] - result['signal']
+        return result
@@ -3,6 +3,7 @@ import sys
 
 from pathlib import Path
 from enum import Enum
+from functools import lru_cache
 from typing import Union, Tuple, Dict, List
 
 import numpy as np
@@ -64,7 +65,31 @@ def two_body_decay_angle(Eb: float = 550, bins: int = 100):
     theta = np.arccos(cos_th(energies).round(6))
     return momentums, ctg(theta)
 
-def cut_two_body_decay_angle(tptot: Union[np.array, pd.Series], ksdpsi: Union[np.array, pd.Series], ebeam_band: Tuple[float, float]) -> Union[np.array, pd.Series]:
+@lru_cache(maxsize=256)
+def decay_angle_band(ebeam_band: Tuple[float, float], bins: int = 500) -> Tuple[np.array, np.array, np.array, np.array]:
+    """Cached kinematic curves (see `two_body_decay_angle`) at both edges of the beam energy band.
+    Returned arrays are read-only, since they are shared between calls.
+    
+    Parameters
+    ----------
+    ebeam_band : Tuple[float, float]
+        KS energy deviation, MeV
+    bins : int
+        length of the curves
+    
+    Returns
+    -------
+    Tuple[np.array, np.array, np.array, np.array]
+        momentums and angles at the lower edge, momentums and angles at the upper edge
+    """
+    
+    mmin, amin = two_body_decay_angle(ebeam_band[0], bins=bins)
+    mmax, amax = two_body_decay_angle(ebeam_band[1], bins=bins)
+    for arr in (mmin, amin, mmax, amax):
+        arr.setflags(write=False)
+    return mmin, amin, mmax, amax
+
+def cut_two_body_decay_angle(tptot: Union[np.array, pd.Series], ksdpsi: Union[np.array, pd.Series], ebeam_band: Tuple[float, float], bins: int = 500) -> Union[np.array, pd.Series]:
     """Pion (from KS decay) momentum (`tptot`) vs angle between two pions (`ksdpsi`) filter
     
     Parameters
@@ -75,6 +100,8 @@ def cut_two_body_decay_angle(tptot: Union[np.array, pd.Series], ksdpsi: Union[np
         angles between pions, rad
     ebeam_band : Tuple[float, float]
         KS energy deviation, MeV
+    bins : int
+        length of the kinematic curves
     
     Returns
     -------
@@ -82,12 +109,64 @@ def cut_two_body_decay_angle(tptot: Union[np.array, pd.Series], ksdpsi: Union[np
         filtering mask
     """
     
-    mmin, amin = two_body_decay_angle(ebeam_band[0], bins=500)
-    mmax, amax = two_body_decay_angle(ebeam_band[1], bins=500)
+    mmin, amin, mmax, amax = decay_angle_band(tuple(map(float, ebeam_band)), bins)
     right_band = np.interp(tptot, mmin, amin)
     left_band = np.interp(tptot, mmax, amax, left=np.pi, right=np.pi)
     return (left_band < ksdpsi) & (ksdpsi < right_band)
 
+def _interp_rows(x: np.array, rows: np.array, xp: np.array, fp: np.array, left: float = None, right: float = None) -> np.array:
+    """`np.interp` of each `x` on its own uniform grid `xp[rows]` (as from `np.linspace`) with values `fp[rows]`"""
+    
+    bins = xp.shape[1]
+    x0, x1 = xp[rows, 0], xp[rows, -1]
+    pos = np.nan_to_num((x - x0)/(x1 - x0)*(bins - 1))
+    i = np.clip(np.floor(pos), 0, bins - 2).astype(np.int64)
+    frac = pos - i
+    y = fp[rows, i]*(1 - frac) + fp[rows, i + 1]*frac
+    y = np.where(x < x0, fp[rows, 0] if left is None else left, y)
+    y = np.where(x > x1, fp[rows, -1] if right is None else right, y)
+    return np.where(np.isnan(x), np.nan, y)
+
+def cut_two_body_decay_angle_batch(tptot: Union[np.array, pd.Series], ksdpsi: Union[np.array, pd.Series], 
+                                   ebeam_band: Tuple[Union[np.array, float], Union[np.array, float]], bins: int = 500) -> Union[np.array, pd.Series]:
+    """`cut_two_body_decay_angle` with per-event beam energy bands, so that multi-energy data is filtered in one call.
+    Kinematic curves are taken from `decay_angle_band` once per distinct band.
+    
+    Parameters
+    ----------
+    tptot : Union[np.array, pd.Series]
+        pion momentums, MeV
+    ksdpsi : Union[np.array, pd.Series]
+        angles between pions, rad
+    ebeam_band : Tuple[Union[np.array, float], Union[np.array, float]]
+        lower and upper edges of KS energy deviation for each event, MeV
+    bins : int
+        length of the kinematic curves
+    
+    Returns
+    -------
+    Union[np.array, pd.Series]
+        filtering mask
+    """
+    
+    x = np.asarray(tptot, dtype=float)
+    low, high = np.broadcast_arrays(np.asarray(ebeam_band[0], dtype=float), np.asarray(ebeam_band[1], dtype=float), x)[:2]
+    # distinct bands are labelled via codes of their distinct lower and upper edges;
+    # NaN edges get code -1 and such events are rejected
+    low_codes, lows = pd.factorize(low.ravel())
+    high_codes, highs = pd.factorize(high.ravel())
+    valid = (low_codes >= 0) & (high_codes >= 0)
+    if not valid.any():
+        mask = np.zeros(x.shape, dtype=bool)
+        return pd.Series(mask, index=ksdpsi.index) if isinstance(ksdpsi, pd.Series) else mask
+    rows = np.zeros(x.size, dtype=np.int64)
+    rows[valid], codes = pd.factorize(low_codes[valid]*len(highs) + high_codes[valid])
+    curves = [decay_angle_band((lows[c//len(highs)], highs[c%len(highs)]), bins) for c in codes]
+    mmin, amin, mmax, amax = (np.stack(c) for c in zip(*curves))
+    right_band = _interp_rows(x.ravel(), rows, mmin, amin).reshape(x.shape)
+    left_band = _interp_rows(x.ravel(), rows, mmax, amax, left=np.pi, right=np.pi).reshape(x.shape)
+    return (left_band < ksdpsi) & (ksdpsi < right_band) & valid.reshape(x.shape)
+
 def get_x(ksminv: pd.Series, ksptot: pd.Series, ebeam: float) -> Tuple[pd.Series, pd.Series]:
     """
     Returns x1, x2 coordinates from pd.DataFrame
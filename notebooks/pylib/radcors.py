@@ -1,8 +1,15 @@
+import os
+import time
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from scipy.interpolate import make_interp_spline
 from scipy.integrate import quad
+from iminuit import Minuit
+from iminuit.cost import LeastSquares
+from typing import List, Tuple, Optional
 from .regeff import RegEff
+from .csapprox import MDVMModel, MDVM_FIXED
 
 class RadCor:
     """
@@ -13,6 +20,8 @@ class RadCor:
     data = None
     x, y = None, None
     radcors = None
+    table = None
+    GL_NODES, GL_WEIGHTS = np.polynomial.legendre.leggauss(8)
 
     def __init__(self, energies, cross_sections, e_threshold=497.6):
         """
@@ -28,6 +37,7 @@ class RadCor:
         
         data = np.array([energies, cross_sections]).T 
         self.data = data[data[:,0].argsort()]
+        self.e_threshold = e_threshold
         spline = make_interp_spline(self.data[:, 0], self.data[:, 1], k=2)
         self.x = np.linspace(e_threshold-10, max(energies), 10000)
         self.y = spline(self.x)
@@ -54,18 +64,51 @@ class RadCor:
         s5 = (1/x)*(1+3*((1-x)**2))*np.log(1/(1-x))
         s6 = - 6 + x
 
-        s7 = 0 if x<(2*m/E) else (1/(6*x))*((x - 2*m/E)**b)*\
-            ((np.log(s*(x**2)/(m**2)) - 5/3)**2)*\
-            (2 - 2*x + x**2 + (b/3)*(np.log(s*(x**2)/(m**2)) - 5/3))
-        s8 = 0 if x<(2*m/E) else ((L**2)/2)*((2/3)*((1-(1-x)**3)/(1-x)) -\
-            (2-x)*np.log(1/(1-x)) + x/2 )
+        # s7, s8 отличны от нуля только при x >= 2m/E, вне этой области подставляется безопасное значение xt
+        above = x>=(2*m/E)
+        xt = np.where(above, x, 0.5)
+        s7 = np.where(above, (1/(6*xt))*((np.abs(xt - 2*m/E))**b)*\
+            ((np.log(s*(xt**2)/(m**2)) - 5/3)**2)*\
+            (2 - 2*xt + xt**2 + (b/3)*(np.log(s*(xt**2)/(m**2)) - 5/3)), 0)
+        s8 = np.where(above, ((L**2)/2)*((2/3)*((1-(1-xt)**3)/(1-xt)) -\
+            (2-xt)*np.log(1/(1-xt)) + xt/2 ), 0)
 
 
         result = b*(x**(b-1))*( 1 + s1 + s2 ) + s3 + \
         (1/8)*(b**2)*(s4 + s5 + s6) + \
         ((a/p)**2)*(s7 + s8)
-        return result
-    def F_Integral(self, e_beam, params, Xmax=1, use_efficiency=True):
+        return result if np.ndim(result) > 0 else float(result)
+    def nodes(self, e_beam, Xmax=1, de=0.5, x_split=1e-3, n_split=50):
+        """
+        Узлы и веса для интеграла по x от 0 до Xmax на энергии пучка e_beam (составная квадратура Гаусса-Лежандра, 8 узлов на отрезок)
+        
+        На [0, x_split] особенность x^(beta-1) убирается заменой t = x^beta (dx = x/(beta*t) dt), по t берётся n_split отрезков.
+        На [x_split, xc] отрезки равномерны по энергии E' = e_beam*sqrt(1-x) с шагом de (МэВ), 
+        чтобы разрешать резонансы сечения. Верхний предел xc обрезается по порогу: выше 1-(e_threshold/e_beam)^2 сечение равно нулю
+        """
+        s = 4*(e_beam**2)
+        b = self.beta(s)
+        xc = min(Xmax, 1 - (self.e_threshold/e_beam)**2)
+        if xc <= 0:
+            return np.zeros(0), np.zeros(0)
+        t0, w0 = RadCor.GL_NODES, RadCor.GL_WEIGHTS
+        composite = lambda a, c, n: (
+            (a + (np.arange(n)[:, None] + 0.5 + 0.5*t0[None, :])*(c - a)/n).ravel(), np.tile(0.5*w0*(c - a)/n, n))
+        x1 = min(xc, x_split)
+        t, wt = composite(0, x1**b, n_split)
+        x = t**(1/b)
+        wt = wt*x/(b*t)
+        if xc <= x1:
+            return x, wt
+        e_lo, e_hi = e_beam*np.sqrt(1 - xc), e_beam*np.sqrt(1 - x1)
+        e, we = composite(e_lo, e_hi, max(int(np.ceil((e_hi - e_lo)/de)), 1))
+        return np.concatenate([x, 1 - (e/e_beam)**2]), np.concatenate([wt, we*2*e/(e_beam**2)])
+    def F_Integral(self, e_beam, params, Xmax=1, use_efficiency=True, method='quad', de=0.5):
+        """
+        Интеграл радиатора, свёрнутого с сечением (и эффективностью регистрации) по x от 0 до Xmax
+        method - 'quad' (адаптивный scipy quad) или 'nodes' (фиксированные узлы `nodes`, 
+        ошибка оценивается сравнением с интегралом с шагом 2*de)
+        """
         s = 4*(e_beam**2)
         sx = 4*(self.x**2)
         if not( np.all(np.diff(sx) > 0) ):
@@ -74,11 +117,119 @@ class RadCor:
             regeff = lambda x: RegEff.sigFunc(np.sqrt(s/4)*x*1e-3, *params) 
         else:
             regeff = lambda x: 1
-        return quad( lambda x: self.F(x, s)*np.interp(s*(1-x), sx, self.y)*regeff(x),
+        integrand = lambda x: self.F(x, s)*np.interp(s*(1-x), sx, self.y)*regeff(x)
+        if method == 'nodes':
+            x, w = self.nodes(e_beam, Xmax, de)
+            x2, w2 = self.nodes(e_beam, Xmax, 2*de)
+            I, I2 = np.sum(w*integrand(x)), np.sum(w2*integrand(x2))
+            return (I, abs(I - I2))
+        return quad( integrand,
                     0., Xmax, points=[0, 1], limit=50000, epsrel=0.0001)
-    def F_Radcor(self, e_beam, params, Xmax=1, use_efficiency=True):
-        integral = self.F_Integral(e_beam, params, Xmax, use_efficiency)
+    def F_Radcor(self, e_beam, params, Xmax=1, use_efficiency=True, method='quad', de=0.5):
+        integral = self.F_Integral(e_beam, params, Xmax, use_efficiency, method, de)
         return ( integral[0]/np.interp(e_beam, self.x, self.y), integral[1]/np.interp(e_beam, self.x, self.y) )
+    def F_Radcor_batch(self, e_beams, params=None, Xmax=1, use_efficiency=True, method='nodes', de=0.5, n_workers=1):
+        """
+        Радпоправки для всех энергий пучка e_beams за один вызов
+        
+        params - параметры эффективности (mu, s, c, N): одни на все энергии или по строке на энергию (массив n x 4 или pd.DataFrame); 
+        без них нужно use_efficiency=False
+        method - 'nodes' (фиксированные узлы, см. `nodes`), 'table' (таблица радиатора, см. `build_table`; 
+        Xmax, de должны совпадать с таблицей, энергии - с её энергиями) или 'quad'
+        n_workers - количество процессов (1 - без пула, None - по числу ядер)
+        
+        Возвращает pd.DataFrame с колонками rad, rad_err, индексированный энергией пучка
+        """
+        if use_efficiency and (params is None):
+            raise ValueError('Efficiency parameters are required with use_efficiency=True')
+        e_beams = np.atleast_1d(np.asarray(e_beams, dtype=float))
+        params = np.broadcast_to(np.asarray(params if params is not None else [np.nan]*4, dtype=float), (e_beams.size, 4))
+        if method == 'table':
+            values = self._radcor_table(e_beams, params, use_efficiency, Xmax, de)
+        elif n_workers == 1:
+            values = self._radcor_chunk(e_beams, params, Xmax, use_efficiency, method, de)
+        else:
+            chunks = [c for c in np.array_split(np.arange(e_beams.size), n_workers or os.cpu_count() or 1) if len(c) > 0]
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(self._radcor_chunk, e_beams[c], params[c], Xmax, use_efficiency, method, de) for c in chunks]
+                values = np.concatenate([f.result() for f in futures])
+        return pd.DataFrame(values, index=pd.Index(e_beams, name='e_beam'), columns=['rad', 'rad_err'])
+    def _radcor_chunk(self, e_beams, params, Xmax, use_efficiency, method, de):
+        return np.array([self.F_Radcor(e, p, Xmax, use_efficiency, method, de) for e, p in zip(e_beams, params)]).reshape(-1, 2)
+    def build_table(self, e_beams, Xmax=1, de=0.5):
+        """
+        Посчитать таблицу радиатора для энергий пучка e_beams: узлы x (см. `nodes`) и радиатор F(x, s), умноженный на веса квадратуры
+        (для шага de и 2*de, для оценки ошибки). Радиатор не зависит ни от сечения, ни от эффективности, 
+        поэтому таблицу можно сохранить (`save_table`) и использовать с другими сечениями (`load_table`)
+        """
+        e_beams = np.unique(np.asarray(e_beams, dtype=float))
+        table = {'e_beams': e_beams, 'e_threshold': self.e_threshold, 'Xmax': Xmax, 'de': de}
+        for key, step in (('', de), ('2', 2*de)):
+            nodes = [self.nodes(e, Xmax, step) for e in e_beams]
+            n_max = max([len(x) for x, _ in nodes] + [1])
+            # дополнение до прямоугольной таблицы: x = 0.5 (безопасная точка) с нулевым весом
+            table['x' + key] = np.full((e_beams.size, n_max), 0.5)
+            table['r' + key] = np.zeros((e_beams.size, n_max))
+            for i, (e, (x, w)) in enumerate(zip(e_beams, nodes)):
+                table['x' + key][i, :len(x)] = x
+                table['r' + key][i, :len(x)] = w*self.F(x, 4*(e**2))
+        self.table = table
+        return table
+    def save_table(self, filename):
+        """
+        Сохранить таблицу радиатора в .npz
+        """
+        np.savez(filename, **self.table)
+    def load_table(self, filename, Xmax=None, de=None):
+        """
+        Загрузить таблицу радиатора из .npz (порог реакции должен совпадать, 
+        Xmax и de, если заданы, - тоже; в файле они хранятся вместе с таблицей)
+        """
+        with np.load(filename) as f:
+            table = {k: f[k] for k in f.files}
+        missing = {'e_beams', 'e_threshold', 'Xmax', 'de', 'x', 'r', 'x2', 'r2'} - set(table)
+        if len(missing) > 0:
+            raise ValueError(f'Radiator table {filename} has no {sorted(missing)}, rebuild it with build_table')
+        if not(np.isclose(table['e_threshold'], self.e_threshold)):
+            raise ValueError(f'Radiator table is built for e_threshold = {table["e_threshold"]}, not {self.e_threshold}')
+        RadCor._check_table(table, Xmax, de)
+        self.table = table
+        return table
+    def _check_table(table, Xmax=None, de=None):
+        for name, value in (('Xmax', Xmax), ('de', de)):
+            if (value is not None) and not(np.isclose(table[name], value)):
+                raise ValueError(f'Radiator table is built for {name} = {table[name]}, not {value}')
+    def _table_positions(self, e_beams, atol=1e-6):
+        """
+        Номера строк таблицы радиатора для энергий e_beams (совпадение с точностью atol, МэВ); 
+        радиатор не интерполируется между энергиями таблицы, поэтому для остальных энергий - ошибка
+        """
+        table_e = self.table['e_beams']
+        # ближайшая энергия таблицы: соседи слева и справа от места вставки
+        idx = np.searchsorted(table_e, e_beams)
+        left, right = np.clip(idx - 1, 0, table_e.size - 1), np.clip(idx, 0, table_e.size - 1)
+        pos = np.where(np.abs(table_e[right] - e_beams) < np.abs(table_e[left] - e_beams), right, left)
+        missing = ~(np.abs(table_e[pos] - e_beams) <= atol)
+        if np.any(missing):
+            raise ValueError(f'Energies {e_beams[missing]} are not in the radiator table, rebuild it with build_table')
+        return pos
+    def _radcor_table(self, e_beams, params, use_efficiency, Xmax=1, de=0.5):
+        if self.table is None:
+            raise ValueError('Radiator table is not built, use build_table or load_table')
+        RadCor._check_table(self.table, Xmax, de)
+        pos = self._table_positions(e_beams)
+        sx = 4*(self.x**2)
+        s = 4*(e_beams[:, None]**2)
+        integrals = []
+        for key in ('', '2'):
+            x, r = self.table['x' + key][pos], self.table['r' + key][pos]
+            f = r*np.interp(s*(1-x), sx, self.y)
+            if use_efficiency:
+                f = f*RegEff.sigFunc(e_beams[:, None]*x*1e-3, *params.T[:, :, None])
+            integrals.append(f.sum(axis=1))
+        I, I2 = integrals
+        cs = np.interp(e_beams, self.x, self.y)
+        return np.column_stack([I/cs, np.abs(I - I2)/cs])
 #     def Calc(self, e_beams=None, rounds=1):
 #         if e_beams is None:
 #             e_beams = self.data[:,0]
@@ -86,4 +237,91 @@ class RadCor:
 #             self.radcors = pd.Series(np.ones(e_beams.size), index=e_beams)
 #         for e_beam in e_beams:
 #             rc, drc = self.F_Radcor(e_beam)
-#             self.radcors
\ No newline at end of file
+#             self.radcors
+
+def iterate_radcors(df: pd.DataFrame, mdvm_params: List[float], fixed: List[str] = MDVM_FIXED, tol: float = 1e-3, max_iter: int = 10,
+                    n_grid: int = 400, method: str = 'nodes', n_workers: int = 1, verbose: bool = True, table: Optional[dict] = None) -> Tuple[pd.DataFrame, pd.DataFrame, Minuit]:
+    """
+    Итерационно согласовать радпоправки и борновское сечение
+    
+    На каждой итерации: борновское сечение = cs_vis/rad фитируется `MDVM`, по фиту строится `RadCor`,
+    и радпоправки пересчитываются для всех точек (все они зависят от нового фита). Остановка, когда за одну итерацию 
+    поправки всех точек изменились меньше чем на tol (относительно)
+    
+    Parameters
+    ----------
+    df : pd.DataFrame
+        точки: emeas (энергия пучка, МэВ), cs_vis, cs_vis_err (сечение без радпоправки, нб), 
+        mu, s, c, N (параметры эффективности `RegEff.sigFunc`), опционально rad (начальные поправки, иначе 1)
+    mdvm_params : List[float]
+        начальные параметры `MDVM.Cross_Section_Neutral`
+    fixed : List[str]
+        фиксированные параметры МДВМ (default is `MDVM_FIXED`)
+    tol : float
+        точность сходимости радпоправок (default is 1e-3)
+    max_iter : int
+        максимальное количество итераций (default is 10)
+    n_grid : int
+        количество точек фита сечения, по которым строится `RadCor` (default is 400)
+    method, n_workers
+        передаются в `RadCor.F_Radcor_batch` (для method='table' таблица радиатора строится один раз на первой итерации)
+    verbose : bool
+        печатать ход итераций (default is True)
+    table : Optional[dict]
+        готовая таблица радиатора для method='table' (`RadCor.build_table`), иначе строится на первой итерации (default is None)
+        
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame, Minuit]
+        точки с колонками rad, rad_err, cs_born, cs_born_err; 
+        история итераций (количество точек, поправка которых изменилась больше чем на tol, максимальное изменение поправки, 
+        chi2/ndf фита, времена); 
+        последний фит сечения
+    """
+    
+    df = df.copy()
+    if 'rad' not in df.columns:
+        df['rad'] = 1.
+    df['rad_err'] = df.get('rad_err', 0.)
+    pars = ['mu', 's', 'c', 'N']
+    model = MDVMModel()
+    history = []
+    for it in range(max_iter):
+        t0 = time.perf_counter()
+        cost = LeastSquares(df['emeas'].values*2e-3, (df['cs_vis']/df['rad']).values, (df['cs_vis_err']/df['rad']).values, model)
+        m = Minuit(cost, *mdvm_params)
+        for par in fixed:
+            m.fixed[par] = True
+        m.simplex().migrad()
+        mdvm_params = list(m.values)
+        t1 = time.perf_counter()
+        
+        xx = np.linspace(2*497.6e-3, df['emeas'].max()*2e-3, n_grid)
+        radcor = RadCor(xx*0.5e3, model(xx, *mdvm_params))
+        if method == 'table':
+            # радиатор не зависит от сечения: таблица строится один раз
+            table = radcor.build_table(df['emeas']) if table is None else table
+            radcor.table = table
+        rad = radcor.F_Radcor_batch(df['emeas'], df[pars], method=method, n_workers=n_workers).values
+        eff0 = RegEff.sigFunc(0, *df[pars].values.T)[:, None]
+        rad = rad/eff0
+        delta = np.abs(rad[:, 0]/df['rad'].values - 1)
+        df['rad'], df['rad_err'] = rad[:, 0], rad[:, 1]
+        t2 = time.perf_counter()
+        
+        history.append({
+            'iteration': it,
+            'n_changed': int((delta > tol).sum()),
+            'max_delta': delta.max() if len(delta) > 0 else 0.,
+            'chi2_ndf': m.fval/max(len(df) - m.nfit, 1),
+            'fit_time': t1 - t0,
+            'radcor_time': t2 - t1,
+        })
+        if verbose:
+            h = history[-1]
+            print(f'iteration {it}: changed {h["n_changed"]}, max delta = {h["max_delta"]:.2e}, '
+                  f'chi2/ndf = {h["chi2_ndf"]:.2f}, fit {h["fit_time"]:.1f} s, radcors {h["radcor_time"]:.1f} s')
+        if not((delta > tol).any()):
+            break
+    df['cs_born'], df['cs_born_err'] = df['cs_vis']/df['rad'], df['cs_vis_err']/df['rad']
+    return df, pd.DataFrame(history).set_index('iteration'), m
@@ -5,27 +5,194 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import uproot
+import awkward as ak
+import numba as nb
 import re
+import os
+import hashlib
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from progressbar import progressbar
 from .style import my_style
 from .preprocess import read_tree
 from scipy import stats
 import warnings
 
+def load_full_values(path):
+    """
+    Суммарная энергия излучённых фотонов (simmom при simtype==22, simorig==0) в событиях MC файла path
+    (события без таких фотонов не попадают)
+    """
+    arr = uproot.open(path)['tr_ph'].arrays(['simmom', 'simtype', 'simorig'])
+    simmom = arr['simmom'][(arr['simtype']==22)&(arr['simorig']==0)]
+    return ak.to_numpy(ak.sum(simmom[ak.num(simmom) > 0], axis=1))
+
+def _load_cached(path, cache_file):
+    if (cache_file is not None) and os.path.isfile(cache_file):
+        return np.load(cache_file)
+    values = load_full_values(path)
+    if cache_file is not None:
+        np.save(cache_file, values)
+    return values
+
+class MCFullValues(Mapping):
+    """
+    Ленивый словарь энергия -> `load_full_values` для MC файлов: файл читается только при первом обращении к его энергии
+    (или заранее `load`, параллельно), результат сохраняется в cache_dir (если задана)
+    """
+    def __init__(self, files, cache_dir=None):
+        self.files = {float(re.findall(r'_(\d+\.?\d*)_', x)[0]) : x for x in files}
+        self.cache_dir = cache_dir
+        self._values = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+    def cache_file(self, energy):
+        if self.cache_dir is None:
+            return None
+        path = self.files[energy]
+        mtime = os.path.getmtime(path) if os.path.isfile(path) else 0
+        key = hashlib.sha1(f'{path}:{mtime}'.encode()).hexdigest()[:10]
+        return os.path.join(self.cache_dir, f'full_values_{energy}_{key}.npy')
+    def __getitem__(self, energy):
+        if energy not in self._values:
+            self._values[energy] = _load_cached(self.files[energy], self.cache_file(energy))
+        return self._values[energy]
+    def __iter__(self):
+        return iter(self.files)
+    def __len__(self):
+        return len(self.files)
+    def load(self, energies=None, n_workers=None):
+        """
+        Загрузить ещё не загруженные энергии (все, если energies is None) в пуле из n_workers процессов (1 - без пула)
+        """
+        energies = [e for e in (self.files if energies is None else energies) if e not in self._values]
+        tasks = [(self.files[e], self.cache_file(e)) for e in energies]
+        if n_workers == 1:
+            values = [_load_cached(*task) for task in progressbar(tasks)]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                values = list(executor.map(_load_cached, *zip(*tasks))) if len(tasks) > 0 else []
+        self._values.update(zip(energies, values))
+        return self
+
+def histogram_rows(values, offsets, hist_max, n_bins):
+    """
+    Гистограммы values по n_bins бинов в диапазонах (0, hist_max[row]) для каждой строки сразу, как np.histogram построчно
+
+    Parameters
+    ----------
+    values : np.ndarray
+        значения, сгруппированные по строкам: values[offsets[row]:offsets[row+1]] - значения строки row
+    offsets : np.ndarray
+        (n_rows+1) границы строк в values
+    hist_max : np.ndarray
+        правая граница диапазона для каждой строки
+    n_bins : int
+        число бинов
+
+    Returns
+    -------
+    counts : np.ndarray
+        (n_rows, n_bins) числа событий в бинах
+    edges : np.ndarray
+        (n_rows, n_bins+1) границы бинов
+    """
+    values, hist_max = np.asarray(values), np.asarray(hist_max)
+    bin_type = np.result_type(values.dtype, hist_max.dtype, np.float16)
+    edges = np.linspace(np.zeros(hist_max.shape), hist_max, n_bins+1, axis=1).astype(bin_type)
+    counts = np.zeros((hist_max.size, n_bins), dtype=np.int64)
+    _fill_rows(values.astype(bin_type, copy=False), np.asarray(offsets, dtype=np.int64), edges, counts)
+    return counts, edges
+
+@nb.njit(parallel=False, fastmath=False)
+def _fill_rows(values, offsets, edges, counts):
+    n_bins = counts.shape[1]
+    for r in range(counts.shape[0]):
+        lo, hi = edges[r, 0], edges[r, n_bins]
+        norm = n_bins/hi
+        for i in range(offsets[r], offsets[r+1]):
+            x = values[i]
+            if not(x >= lo and x <= hi):
+                continue
+            j = min(int(x*norm), n_bins-1)
+            #Поправка на округление, чтобы бины совпадали с np.histogram
+            if x < edges[r, j]:
+                j -= 1
+            elif j != n_bins-1 and x >= edges[r, j+1]:
+                j += 1
+            counts[r, j] += 1
+
+FIT_COLUMNS = ['mu', 's', 'c', 'N', 'mu_err', 's_err', 'c_err', 'N_err', 'eff0', 'eff0_err']
+
+def plot_regeff(data, data_errs, bins, values, errors, fval, title=None, data_color=None, fit_color=None, bbox_color=None, grid_alpha=(0.5, 0.3)):
+    """Картинка фита эффективности регистрации: гистограмма, sigFunc с параметрами values и текст с chi2 и параметрами"""
+    fig, ax = plt.subplots()
+    xx = np.linspace(0, np.max(bins), 100)
+    ax.errorbar(bins, data, yerr=data_errs, fmt='.', color=data_color)
+    ax.plot(xx, RegEff.sigFunc(xx, *values), color=fit_color)
+    my_style(title=title, xlim=(0, np.max(bins)), ylim=(0, None), 
+            xtitle='$E_{\\gamma}$, GeV', ytitle='$\\varepsilon_{reg}$', grid_alpha=grid_alpha)
+    chi2, ndf = fval, len(bins)-len(values)-1
+    s =  f'$\\chi^2$ / ndf = {chi2:.2f} / {ndf}\n'
+    s += f'p-value: {1-stats.chi2.cdf(chi2, ndf):.2f}\n'
+    for var, val, err in zip(FIT_COLUMNS, values, errors):
+        s += f'{var} = {val:1.3f}$\\pm${err:.4f}\n'
+    props = dict(boxstyle='square', facecolor=bbox_color, alpha=0.5)
+    ax.text(0.65, 0.95, s.strip(), transform=ax.transAxes,
+           verticalalignment='top', bbox=props)
+    return fig
+
+def _save_plot(path, kwargs):
+    fig = plot_regeff(**kwargs)
+    fig.savefig(path)
+    plt.close(fig)
+
+class RegEffHistograms():
+    """
+    Гистограммы эффективности регистрации по энергии фотона для всех энергий пучка (строка - энергия)
+
+    energies - энергии пучка, bins - центры бинов, passed/total - числа зарегистрированных/всех событий в бинах,
+    eff/eff_err - байесовская оценка эффективности и её ошибка
+    """
+    def __init__(self, energies, bins, passed, total, eff, eff_err):
+        self.energies = energies
+        self.bins = bins
+        self.passed = passed
+        self.total = total
+        self.eff = eff
+        self.eff_err = eff_err
+    @property
+    def n_bins(self):
+        return self.bins.shape[1]
+    def __len__(self):
+        return self.energies.size
+    def __getitem__(self, index):
+        """(data, data_errs, bins) для энергии с номером index, как RegEff.get_histogram_by_index"""
+        return (self.eff[index], self.eff_err[index], self.bins[index])
+
 class RegEff():
-    def __init__(self, df_mc, data_file, dc_corr_file=None):
+    def __init__(self, df_mc, data_file, dc_corr_file=None, lazy=True, n_workers=1, cache_dir=None):
+        """
+        lazy - читать MC файл энергии только когда он нужен (иначе все сразу, в n_workers процессах)
+        cache_dir - директория для кэша сумм энергий фотонов по событиям (None - без кэша)
+        """
         self.df = df_mc[['emeas', 'x1', 'sim_energy', 'tth[0]', 'tth[1]']].sort_index().copy() if df_mc is not None else None
         file = list(map(lambda x: x.strip(), open(data_file).readlines()[1:])) if data_file is not None else None
         if self.df is not None:
-            alldat = lambda x: uproot.open(x)['tr_ph'].arrays(filter_name=['simmom'], library='pd', cut='(simtype==22)&(simorig==0)').groupby('entry').sum().values.ravel()
-            self.full_values = {float(re.findall(r'_(\d+\.?\d*)_', x)[0]) : alldat(x) for x in progressbar(file)}
+            self.full_values = MCFullValues(file, cache_dir)
+            if not(lazy):
+                self.full_values.load(n_workers=n_workers)
             self.uniques = self.df.index.unique()
         else:
             self.full_values = None
             self.uniques = None
         self.histos = None
         self.fit_name = None
-        self.fit_results = None
+        # результаты фитов: строка на энергию из self.uniques (FIT_COLUMNS) и маска уже профитированных
+        self.fit_values = None
+        self.fitted = None
+        self.global_minuit = None
+        self.fit_inputs = {}
     def __variance(self, k, n):
         return (k+1)*(k+2)/(n+2)/(n+3) - (k+1)**2/(n+2)**2
 #     def __chi2(self, mu, s, c, N, a):
@@ -33,6 +200,16 @@ class RegEff():
 #         return np.sum( np.square((points - RegEff.sigFunc(xedges, mu, s, c, N, a))/errs) )
     def __len__(self):
         return self.uniques.size
+    @property
+    def fit_results(self):
+        """Таблица результатов фитов (FIT_COLUMNS) только для уже профитированных энергий (None, если фитов не было)"""
+        if self.fit_values is None:
+            return None
+        return pd.DataFrame(self.fit_values[self.fitted], index=self.uniques[self.fitted], columns=FIT_COLUMNS)
+    def _allocate_fit_results(self, n):
+        if (self.fit_values is None) or (len(self.fit_values) != n):
+            self.fit_values = np.full((n, len(FIT_COLUMNS)), np.nan)
+            self.fitted = np.zeros(n, dtype=bool)
     def __getitem__(self, index):
         if index>=self.__len__() or index<0:
             raise ValueError(f'Wrong index: {index}')
@@ -60,75 +237,119 @@ class RegEff():
 #         data_errs = np.sqrt(err.groupby(err.index).agg('sum')).reindex(index=np.arange(n_bins)).fillna(0)/data2
 #         print(data_errs)
         return (data, data_errs, bins)
-    def fit_data(data, data_errs, bins, data_color=None, fit_color=None, bbox_color=None, mu0=0.02, s0=1/250, name=None):
+    def get_histograms(self, n_bins):
+        """
+        Гистограммы эффективности для всех энергий за один проход (то же, что get_histogram_by_index для каждой энергии),
+        результат сохраняется в self.histos
+        """
+        fulls = [self.full_values[e] for e in self.uniques]
+        hist_max = np.array([np.max(f) for f in fulls])
+        #self.df отсортирован по энергии, поэтому строки идут подряд
+        passed, edges = histogram_rows(self.df.sim_energy.values, np.searchsorted(self.df.index.values, np.append(self.uniques.values, np.inf)), hist_max, n_bins)
+        total, edges = histogram_rows(np.concatenate(fulls), np.cumsum([0] + [f.size for f in fulls]), hist_max, n_bins)
+        eff = (passed+1)/(total+2)
+        eff_err = np.sqrt(self.__variance(passed, total))
+        self.histos = RegEffHistograms(np.asarray(self.uniques), (edges[:, 1:] + edges[:, :-1])/2, passed, total, eff, eff_err)
+        return self.histos
+    def fit_global(self, n_bins=100, deg=2, mu0=0.02, s0=1/250):
+        """
+        Совместный фит эффективности регистрации при всех энергиях: параметры sigFunc - полиномы степени deg
+        по энергии пучка (нормированной на [-1, 1]), минимизируется общий chi2 по всем точкам
+
+        Returns
+        -------
+        fit_results : pd.DataFrame
+            таблица, как у fit (параметры, их ошибки, eff0, eff0_err для каждой энергии), сохраняется в self.fit_results;
+            Minuit с коэффициентами полиномов - в self.global_minuit
+        """
+        histos = self.histos if (self.histos is not None) and (self.histos.n_bins == n_bins) else self.get_histograms(n_bins)
+        energies = histos.energies
+        deg = min(deg, len(energies)-1)
+        t = (2*energies - energies.max() - energies.min())/(energies.max() - energies.min()) if len(energies) > 1 else np.zeros(1)
+        vander = np.vander(t, deg+1, increasing=True)
+        names = ('mu', 's', 'c', 'N')
+        
+        def chi2(coefs):
+            mu, s, c, N = (coefs.reshape(4, deg+1) @ vander.T)[:, :, None]
+            return np.sum(np.square((histos.eff - RegEff.sigFunc(histos.bins, mu, s, c, N))/histos.eff_err))
+        
+        coefs0 = np.zeros((4, deg+1))
+        coefs0[:, 0] = (mu0, s0, 0.004, 0.35)
+        m = Minuit(chi2, coefs0.ravel(), name=[f'{p}{k}' for p in names for k in range(deg+1)])
+        m.errordef = Minuit.LEAST_SQUARES
+        m.migrad().hesse()
+        
+        if not(m.accurate):
+            warnings.warn('Minuit troubles')
+        
+        coefs, cov = np.array(m.values).reshape(4, deg+1), np.array(m.covariance)
+        mu, s, c, N = values = coefs @ vander.T
+        #ошибки параметров и eff0 в каждой точке - через ковариационную матрицу коэффициентов
+        blocks = cov.reshape(4, deg+1, 4, deg+1)
+        errors = np.sqrt(np.einsum('ek,pkpl,el->pe', vander, blocks, vander))
+        g = expit(-mu/s)
+        grad = np.array([N*g*(1-g)/s, -N*g*(1-g)*mu/s**2, N, 1 - g + c])
+        jac = (grad.T[:, :, None]*vander[:, None, :]).reshape(len(energies), -1)
+        eff0 = RegEff.sigFunc(0, mu, s, c, N)
+        eff0_err = np.sqrt(np.einsum('ei,ij,ej->e', jac, cov, jac))
+        
+        self._allocate_fit_results(len(energies))
+        self.fit_values[:] = np.column_stack([values.T, errors.T, eff0, eff0_err])
+        self.fitted[:] = True
+        self.global_minuit = m
+        return self.fit_results
+    def sigmoid_minuit(data, data_errs, bins, mu0=0.02, s0=1/250):
+        """Minuit для фита sigFunc по гистограмме эффективности (без запуска)"""
         parameters = {
             'mu' : mu0,
             's' : s0,
             'c' : 0.004,
             'N' : 0.35,
         }
-        parameters_options = {
-            'mu' : ([0, 1], 0.01),
-            's' : ([0,1], 1/250),
-            'c' : ([0,1], 0.01),
-            'N' : ([0,1], 0.05),
-        }
-        m = Minuit(LeastSquares(bins, data, data_errs, RegEff.sigFunc), **parameters)
-#         for par in m.parameters:
-#             m.limits[par], m.errors[par] = parameters_options[par]
+        return Minuit(LeastSquares(bins, data, data_errs, RegEff.sigFunc), **parameters)
+    def fit_row(m):
+        """Результат фита: значения и ошибки параметров, eff0, eff0_err (в порядке FIT_COLUMNS)"""
+        eff0 = RegEff.sigFunc(0, *m.values)
+        eff0_err = RegEff.sigFunc(0, *(np.array(m.values)+np.array(m.errors))) - eff0
+        return np.array(list(m.values) + list(m.errors) + [eff0, eff0_err])
+    def fit_data(data, data_errs, bins, data_color=None, fit_color=None, bbox_color=None, mu0=0.02, s0=1/250, name=None, plot=True):
+        """
+        Фит гистограммы эффективности (data, data_errs, bins), возвращает таблицу из одной строки name
+
+        plot - сразу нарисовать результат (при False - без matplotlib, картинку можно получить потом через plot_regeff)
+        """
+        m = RegEff.sigmoid_minuit(data, data_errs, bins, mu0, s0)
         m.simplex().migrad().hesse().hesse()
         
         if not(m.accurate):
             warnings.warn('Minuit troubles')
-
-        columns = []
-        columns += m.parameters
-        columns += ( tuple(map(lambda x: f'{x}_err', m.parameters)) + ('eff0', 'eff0_err') )
-        fit_results = pd.DataFrame(columns=columns)
         
-        eff0 = RegEff.sigFunc(0, *m.values)
-        eff0_err = RegEff.sigFunc(0, *(np.array(m.values)+np.array(m.errors))) - eff0
-        temp_ser = pd.Series(list(m.values) + list(m.errors) + [eff0, eff0_err], index=fit_results.columns, name=name)
-        fit_results = fit_results.append(temp_ser)
-        
-            
-        fig, ax = plt.subplots()
-        xx = np.linspace(0, np.max(bins), 100)
-        ax.errorbar(bins, data, yerr=data_errs, fmt='.', color=data_color)
-        ax.plot(xx, RegEff.sigFunc(xx, *m.values), color=fit_color)
-        my_style(title=(name if name is not None else 'Registration eff. vs rad. photon energy'), xlim=(0, np.max(bins)), ylim=(0, None), 
-                xtitle='$E_{\\gamma}$, GeV', ytitle='$\\varepsilon_{reg}$', grid_alpha=(0.3, 0.1))
-        values_dict = dict(zip(m.parameters, m.values))
-        chi2, ndf = m.fval, len(bins)-len(m.parameters)-1
-        s =  f'$\\chi^2$ / ndf = {chi2:.2f} / {ndf}\n'
-        s += f'p-value: {1-stats.chi2.cdf(chi2, ndf):.2f}\n'
-        for var, val, err, fixed in zip(m.parameters, m.values, m.errors, m.fixed):
-            if fixed:
-                s += f'{var} = {val:1.3f}\n'
-            else:
-                s += f'{var} = {val:1.3f}$\\pm${err:.4f}\n'
-        props = dict(boxstyle='square', facecolor=bbox_color, alpha=0.5)
-        ax.text(0.65, 0.95, s.strip(), transform=ax.transAxes,
-               verticalalignment='top', bbox=props)
+        fit_results = pd.DataFrame([RegEff.fit_row(m)], columns=FIT_COLUMNS, index=[name])
+        if plot:
+            plot_regeff(data, data_errs, bins, m.values, m.errors, m.fval, 
+                        title=(name if name is not None else 'Registration eff. vs rad. photon energy'),
+                        data_color=data_color, fit_color=fit_color, bbox_color=bbox_color, grid_alpha=(0.3, 0.1))
         return fit_results
-    def fit(self, index, n_bins=100, data_color=None, fit_color=None, bbox_color=None, data=None, mu0=0.02, s0=1/250):
+    def fit(self, index, n_bins=100, data_color=None, fit_color=None, bbox_color=None, data=None, mu0=0.02, s0=1/250, plot=True):
+        """
+        Фит эффективности регистрации при энергии с номером index, результат - в строке self.fit_results 
+        (таблица содержит только уже профитированные энергии)
+
+        plot - сразу нарисовать результат (при False - без matplotlib, картинку можно получить потом через plot или save_plots)
+        """
         if data is not None:
             data, data_errs, bins = data
+        elif (self.histos is not None) and (self.histos.n_bins == n_bins):
+            data, data_errs, bins = self.histos[index]
         else:
             data, data_errs, bins = self.get_histogram_by_index(index, n_bins)
-        parameters = {
-            'mu' : mu0,
-            's' : s0,
-            'c' : 0.004,
-            'N' : 0.35,
-        }
         parameters_options = {
             'mu' : ([0, 1], 0.01),
             's' : ([0,1], 1/25),
             'c' : ([0,1], 0.01),
             'N' : ([0,1], 0.05),
         }
-        m = Minuit(LeastSquares(bins, data, data_errs, RegEff.sigFunc), **parameters)
+        m = RegEff.sigmoid_minuit(data, data_errs, bins, mu0, s0)
         for par in m.parameters:
             m.limits[par], m.errors[par] = parameters_options[par]
         m.migrad()
@@ -136,34 +357,32 @@ class RegEff():
         if not(m.accurate):
             warnings.warn('Minuit troubles')
 
-        if self.fit_results is None:
-            columns = []
-            columns += m.parameters
-            columns += ( tuple(map(lambda x: f'{x}_err', m.parameters)) + ('eff0', 'eff0_err') )
-            self.fit_results = pd.DataFrame(columns=columns)
-        eff0 = RegEff.sigFunc(0, *m.values)
-        eff0_err = RegEff.sigFunc(0, *(np.array(m.values)+np.array(m.errors))) - eff0
-        temp_ser = pd.Series(list(m.values) + list(m.errors) + [eff0, eff0_err], index=self.fit_results.columns, name=self.index2energy(index))
-        if temp_ser.name in self.fit_results.index:
-            self.fit_results.drop(temp_ser.name, axis=0, inplace=True)
-        self.fit_results = self.fit_results.append(temp_ser)
-            
-        fig, ax = plt.subplots()
-        xx = np.linspace(0, np.max(bins), 100)
-        ax.errorbar(bins, data, yerr=data_errs, fmt='.', color=data_color)
-        ax.plot(xx, RegEff.sigFunc(xx, *m.values), color=fit_color)
-        my_style(title=f'Registration eff. vs rad. photon energy ($\sqrt{{s}}$ = {self.index2energy(index)*2e-3:.3f} GeV)', xlim=(0, np.max(bins)), ylim=(0, None), 
-                xtitle='$E_{\\gamma}$, GeV', ytitle='$\\varepsilon_{reg}$')
-        values_dict = dict(zip(m.parameters, m.values))
-        chi2, ndf = m.fval, len(bins)-len(m.parameters)-1
-        s =  f'$\\chi^2$ / ndf = {chi2:.2f} / {ndf}\n'
-        s += f'p-value: {1-stats.chi2.cdf(chi2, ndf):.2f}\n'
-        for var, val, err, fixed in zip(m.parameters, m.values, m.errors, m.fixed):
-            if fixed:
-                s += f'{var} = {val:1.3f}\n'
-            else:
-                s += f'{var} = {val:1.3f}$\\pm${err:.4f}\n'
-        props = dict(boxstyle='square', facecolor=bbox_color, alpha=0.5)
-        ax.text(0.65, 0.95, s.strip(), transform=ax.transAxes,
-               verticalalignment='top', bbox=props)
-        return 
\ No newline at end of file
+        self._allocate_fit_results(len(self.uniques))
+        self.fit_values[index] = RegEff.fit_row(m)
+        self.fitted[index] = True
+        self.fit_inputs[index] = (data, data_errs, bins, np.array(m.values), np.array(m.errors), m.fval)
+        
+        if plot:
+            self.plot(index, data_color, fit_color, bbox_color)
+        return
+    def plot_kwargs(self, index):
+        energy = self.index2energy(index)
+        data, data_errs, bins, values, errors, fval = self.fit_inputs[index]
+        return dict(data=data, data_errs=data_errs, bins=bins, values=values, errors=errors, fval=fval,
+                    title=f'Registration eff. vs rad. photon energy ($\\sqrt{{s}}$ = {energy*2e-3:.3f} GeV)')
+    def plot(self, index, data_color=None, fit_color=None, bbox_color=None):
+        """Нарисовать результат уже сделанного fit(index)"""
+        return plot_regeff(**self.plot_kwargs(index), data_color=data_color, fit_color=fit_color, bbox_color=bbox_color)
+    def save_plots(self, directory, n_workers=1, fmt='png', **kwargs):
+        """
+        Сохранить картинки всех сделанных фитов в directory/{index}.{fmt} (в n_workers процессах, 1 - без пула),
+        kwargs передаются в plot_regeff
+        """
+        os.makedirs(directory, exist_ok=True)
+        tasks = [(os.path.join(directory, f'{index}.{fmt}'), {**self.plot_kwargs(index), **kwargs}) for index in sorted(self.fit_inputs)]
+        if n_workers == 1:
+            for task in tasks:
+                _save_plot(*task)
+        elif len(tasks) > 0:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(_save_plot, *zip(*tasks)))
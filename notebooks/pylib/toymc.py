@@ -0,0 +1,154 @@
+import os
+import glob
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+from .csapprox import MDVMModel, MDVM_PARAMETERS, MDVM_FIXED
+from .radcors import RadCor, iterate_radcors
+
+def make_toy(df: pd.DataFrame, mdvm_params: List[float], seed) -> pd.DataFrame:
+    """
+    Псевдоэксперимент: видимые сечения разыгрываются нормальным распределением вокруг 
+    ожидания по фиту (борновское сечение МДВМ, умноженное на радпоправку) с ошибками cs_vis_err
+    
+    Parameters
+    ----------
+    df : pd.DataFrame
+        точки (результат `iterate_radcors`): emeas, cs_vis_err, rad, mu, s, c, N
+    mdvm_params : List[float]
+        параметры фита сечения
+    seed
+        зерно генератора (для воспроизводимости тоя)
+    """
+    
+    rng = np.random.default_rng(seed)
+    toy = df.copy()
+    expected = MDVMModel()(df['emeas'].values*2e-3, *mdvm_params)*df['rad'].values
+    toy['cs_vis'] = expected + rng.normal(size=len(df))*df['cs_vis_err'].values
+    return toy
+
+# таблица радиатора процесса-исполнителя (см. `_init_worker`)
+_TABLE = None
+
+def _init_worker(table):
+    """
+    Запомнить таблицу радиатора в процессе один раз, а не передавать её с каждым тоем
+    """
+    global _TABLE
+    _TABLE = table
+
+def _run_toy(args) -> dict:
+    """
+    Разыграть и профитировать один той (таблица радиатора берётся из `_TABLE`)
+    """
+    toy_id, base_seed, df, mdvm_params, fixed, tol, max_iter, method = args
+    toy = make_toy(df, mdvm_params, [base_seed, toy_id])
+    row = {'toy': toy_id, 'seed': base_seed}
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            res, history, m = iterate_radcors(toy, mdvm_params, fixed, tol, max_iter, method=method, verbose=False, table=_TABLE)
+        row.update({'valid': m.valid, 'chi2': m.fval, 'n_iter': len(history), 'error': None})
+        row.update(dict(zip(MDVM_PARAMETERS, m.values)))
+        row.update({f'rad_{i}': v for i, v in enumerate(res['rad'].values)})
+        row.update({f'cs_born_{i}': v for i, v in enumerate(res['cs_born'].values)})
+    except Exception as e:
+        row.update({'valid': False, 'error': repr(e)})
+    return row
+
+def load_toys(out_dir: str) -> pd.DataFrame:
+    """
+    Прочитать все сохранённые результаты тоев из out_dir
+    """
+    
+    parts = sorted(glob.glob(os.path.join(out_dir, 'part-*.parquet')))
+    csvs = sorted(glob.glob(os.path.join(out_dir, 'part-*.csv')))
+    frames = [pd.read_parquet(f) for f in parts] + [pd.read_csv(f) for f in csvs]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True).sort_values('toy').set_index('toy')
+
+def _write_part(df: pd.DataFrame, out_dir: str, first: int):
+    # запись через временный файл: прерванный прогон не оставит недописанный кусок, который прочтёт `load_toys`
+    filename = os.path.join(out_dir, f'part-{first:07d}')
+    try:
+        df.to_parquet(filename + '.tmp', index=False)
+        ext = '.parquet'
+    except ImportError:
+        warnings.warn('Parquet engine is not available, csv is used', UserWarning)
+        df.to_csv(filename + '.tmp', index=False)
+        ext = '.csv'
+    os.replace(filename + '.tmp', filename + ext)
+
+def run_toys(df: pd.DataFrame, mdvm_params: List[float], n_toys: int, out_dir: str, seed: int = 0, fixed: List[str] = MDVM_FIXED, 
+             n_workers: Optional[int] = None, batch_size: int = 100, tol: float = 1e-3, max_iter: int = 5, method: str = 'table') -> pd.DataFrame:
+    """
+    Toy MC для ошибок сечения и радпоправок: n_toys псевдоэкспериментов (`make_toy`), 
+    каждый фитируется `iterate_radcors` в пуле из n_workers процессов
+    
+    Зерно тоя - (seed, номер тоя), поэтому результат не зависит от количества процессов и порядка выполнения.
+    Результаты пишутся в out_dir кусками по batch_size тоев (parquet, если доступен, иначе csv); 
+    при повторном запуске уже посчитанные тои пропускаются, так что прерванный прогон можно продолжить
+    
+    Parameters
+    ----------
+    df : pd.DataFrame
+        точки (результат `iterate_radcors`)
+    mdvm_params : List[float]
+        параметры фита сечения, по которому разыгрываются тои
+    n_toys : int
+        количество тоев
+    out_dir : str
+        директория для результатов
+    seed : int
+        базовое зерно (default is 0)
+    fixed, tol, max_iter, method
+        передаются в `iterate_radcors` (для method='table' таблица радиатора строится один раз на все тои 
+        и передаётся в каждый процесс при его запуске, см. `_init_worker`)
+    n_workers : Optional[int]
+        количество процессов (None - по числу ядер, 1 - без пула) (default is None)
+    batch_size : int
+        количество тоев в одном файле (default is 100)
+        
+    Returns
+    -------
+    pd.DataFrame
+        по строке на той: valid, chi2, параметры МДВМ, rad_i и cs_born_i для точек
+    """
+    
+    os.makedirs(out_dir, exist_ok=True)
+    done = load_toys(out_dir)
+    if len(done) > 0 and (done['seed'] != seed).any():
+        raise ValueError(f'{out_dir} contains toys with another seed')
+    todo = [i for i in range(n_toys) if i not in set(done.index)]
+    table = None
+    if method == 'table' and len(todo) > 0:
+        # радиатор не зависит от сечения: таблица строится на фиктивном сечении
+        grid = np.linspace(497.6, df['emeas'].max(), 10)
+        table = RadCor(grid, np.ones_like(grid)).build_table(df['emeas'])
+    
+    if n_workers != 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(table,))
+    else:
+        executor = None
+        _init_worker(table)
+    try:
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            tasks = [(i, seed, df, mdvm_params, fixed, tol, max_iter, method) for i in batch]
+            rows = list(executor.map(_run_toy, tasks)) if executor is not None else [_run_toy(t) for t in tasks]
+            _write_part(pd.DataFrame(rows), out_dir, batch[0])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return load_toys(out_dir)
+
+def summarize_toys(toys: pd.DataFrame) -> pd.DataFrame:
+    """
+    Среднее и стандартное отклонение величин по успешным тоям
+    """
+    
+    good = toys.query('valid == True').drop(columns=['seed', 'valid', 'error'], errors='ignore')
+    return pd.DataFrame({'mean': good.mean(), 'std': good.std(), 'n_toys': good.count()})
@@ -0,0 +1,103 @@
+import os
+import re
+import sys
+
+import numpy as np
+import awkward as ak
+import uproot
+import pytest
+from collections import namedtuple
+
+NOTEBOOKS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, NOTEBOOKS)
+
+@pytest.fixture(autouse=True)
+def notebooks_cwd(monkeypatch):
+    # pylib reads badruns.dat by a path relative to notebooks/
+    monkeypatch.chdir(NOTEBOOKS)
+
+Report = namedtuple('Report', ['tree_entry_start', 'tree_entry_stop'])
+
+class FakeTree:
+    """
+    Дерево tr_ph для тестов: uproot не умеет записывать ksvind[nks][2], поэтому он хранится плоской веткой ksvindflat, 
+    а cut/aliases в arrays вычисляются здесь; остальное (байты, корзины, ветки) - от настоящего дерева
+    """
+    def __init__(self, path):
+        self.tree = uproot.open(path)['tr_ph']
+        self.names = set(self.tree.keys()) | {'ksvind'}
+    def arrays(self, expressions=None, cut=None, aliases=None, entry_start=None, entry_stop=None, library='ak', filter_name=None, **kwargs):
+        expressions = filter_name if filter_name is not None else expressions
+        aliases = aliases or {}
+        text = ' '.join(list(expressions) + ([cut] if cut else []) + list(aliases.values()))
+        names = sorted(set(re.findall(r'[A-Za-z_][A-Za-z_0-9]*', text)) & self.names)
+        real = [n if n != 'ksvind' else 'ksvindflat' for n in names]
+        arrs = self.tree.arrays(real, entry_start=entry_start, entry_stop=entry_stop)
+        ns = {n: arrs[n] for n in names if n != 'ksvind'}
+        if 'ksvind' in names:
+            ns['ksvind'] = ak.unflatten(arrs['ksvindflat'], 2, axis=1)
+        ns.update(abs=np.abs, sqrt=np.sqrt, sin=np.sin, cos=np.cos)
+        for k, v in aliases.items():
+            ns[k] = eval(v, {}, ns)
+        arr = ak.zip({e: ns[e] if e in ns else eval(e, {}, ns) for e in expressions}, depth_limit=1)
+        if cut:
+            arr = arr[eval(cut, {}, ns)]
+        return ak.to_pandas(arr) if library == 'pd' else arr
+    def iterate(self, expressions=None, cut=None, aliases=None, step_size=1000, library='ak', report=False, **kwargs):
+        n = self.tree.num_entries
+        step = self.tree.num_entries_for(step_size) if isinstance(step_size, str) else step_size
+        for start in range(0, n, step):
+            stop = min(n, start + step)
+            arr = self.arrays(expressions, cut, aliases, entry_start=start, entry_stop=stop, library=library)
+            yield (arr, Report(start, stop)) if report else arr
+    def __getitem__(self, key):
+        return self.tree[key]
+    def __getattr__(self, key):
+        return getattr(self.tree, key)
+
+def write_tree(path, n_baskets=4, basket_size=3000, kaon_baskets=None, emeas=lambda rng, n: np.full(n, 551.), seed=0):
+    """
+    Синтетическое дерево tr_ph из n_baskets корзин по basket_size событий; 
+    в корзинах не из kaon_baskets (None - все) нет событий с nks>0
+    """
+    rng = np.random.default_rng(seed)
+    jag = lambda counts, gen: ak.unflatten(gen(int(counts.sum())), counts)
+    with uproot.recreate(path) as f:
+        for i in range(n_baskets):
+            n = basket_size
+            nt = rng.choice([1, 2, 3, 4], n, p=[0.1, 0.4, 0.1, 0.4])
+            nks = np.where(nt >= 4, 2, np.where(nt >= 2, 1, 0))
+            if (kaon_baskets is not None) and (i not in kaon_baskets):
+                nks[:] = 0
+            nph = rng.integers(0, 4, n)
+            nsim = rng.integers(1, 5, n)
+            em = emeas(rng, n).astype(np.float32)
+            tptot = jag(nt, lambda m: rng.uniform(60, 450, m).astype(np.float32))
+            data = dict(
+                nt=nt.astype(np.int32), nks=nks.astype(np.int32), 
+                ebeam=em - 1, emeas=em, lumoff=np.ones(n, np.float32), lumofferr=np.full(n, 0.1, np.float32),
+                runnum=rng.choice([1, 2, 3], n).astype(np.int32), finalstate_id=rng.integers(0, 4, n).astype(np.int32),
+                trigbits=rng.integers(1, 4, n).astype(np.int32),
+                tnhit=jag(nt, lambda m: rng.integers(5, 30, m).astype(np.int32)), tptot=tptot,
+                tdedx=ak.values_astype(5.58030e+9 / (tptot + 40.)**3 + 2.21228e+3 - 3.77103e-1 * tptot + jag(nt, lambda m: rng.normal(0, 1000, m)), np.float32),
+                tchi2r=jag(nt, lambda m: rng.uniform(0, 22, m).astype(np.float32)), tchi2z=jag(nt, lambda m: rng.uniform(0, 22, m).astype(np.float32)),
+                tz=jag(nt, lambda m: rng.normal(0, 6, m).astype(np.float32)),
+                tcharge=jag(nt, lambda m: np.tile([1, -1], m//2 + 1)[:m].astype(np.int32)),
+                trho=jag(nt, lambda m: rng.normal(0, 1, m).astype(np.float32)), tth=jag(nt, lambda m: rng.uniform(0.5, 2.6, m).astype(np.float32)),
+                tphi=jag(nt, lambda m: rng.uniform(0, 6.28, m).astype(np.float32)),
+                ksalign=jag(nks, lambda m: rng.uniform(0.7, 1, m).astype(np.float32)), ksminv=jag(nks, lambda m: rng.normal(497.6, 40, m).astype(np.float32)),
+                ksptot=jag(nks, lambda m: rng.normal(110, 40, m).astype(np.float32)), ksdpsi=jag(nks, lambda m: rng.uniform(1, 3.1, m).astype(np.float32)),
+                ksz0=jag(nks, lambda m: rng.normal(0, 3, m).astype(np.float32)), kslen=jag(nks, lambda m: rng.exponential(0.5, m).astype(np.float32)),
+                ksth=jag(nks, lambda m: rng.uniform(0.5, 2.6, m).astype(np.float32)), ksphi=jag(nks, lambda m: rng.uniform(0, 6.28, m).astype(np.float32)),
+                ksvindflat=ak.unflatten(np.concatenate([np.arange(2*k, dtype=np.int32) for k in nks]), 2*nks),
+                phen=jag(nph, lambda m: rng.exponential(80, m).astype(np.float32)), phth=jag(nph, lambda m: rng.uniform(0.5, 2.6, m).astype(np.float32)),
+                phphi=jag(nph, lambda m: rng.uniform(0, 6.28, m).astype(np.float32)),
+                simtype=jag(nsim, lambda m: rng.choice([22, 211, 130], m).astype(np.int32)),
+                simorig=jag(nsim, lambda m: rng.choice([0, 1], m).astype(np.int32)),
+                simmom=jag(nsim, lambda m: rng.exponential(30, m).astype(np.float32)),
+            )
+            if i == 0:
+                f['tr_ph'] = data
+            else:
+                f['tr_ph'].extend(data)
+    return path
@@ -0,0 +1,60 @@
+import os
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pylib.ksks as ksks
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(ksks, 'CACHE_DIR', str(tmp_path))
+    return tmp_path
+
+def make_cut_kaons(n=50, e=510.):
+    rng = np.random.default_rng(0)
+    th = rng.uniform(0.5, 2.6, n)
+    return pd.DataFrame({'ksth': np.column_stack([th, np.pi - th]).ravel(), 'ksphi': np.tile([0, np.pi], n), 'ksminv': 497.6,
+                         'ksptot': np.sqrt(e**2 - 497.6**2), 'kslen': 1., 'emeas': e, 'finalstate_id': 2}, 
+                        index=pd.MultiIndex.from_product([np.arange(n), [0, 1]], names=['entry', 'subentry']))
+
+def test_cache_key_does_not_depend_on_source_visibility(cache_dir):
+    tree_path = str(cache_dir / 'exp.root')
+    key = ksks.cache_key(tree_path)
+    open(tree_path, 'wb').close()
+    assert ksks.cache_key(tree_path) == key
+    assert ksks.cache_key(tree_path, {}) != key
+
+def test_find_cache_checks_source_only_when_reachable(cache_dir):
+    tree_path = str(cache_dir / 'exp.root')
+    open(tree_path, 'wb').close()
+    key = ksks.cache_key(tree_path)
+    filename = ksks.write_cache(make_cut_kaons(), 'exp', 'p1', key, 'csv', tree_path)
+    assert ksks.find_cache('exp', 'p1', key, tree_path) == filename
+    
+    with open(tree_path, 'wb') as f:
+        f.write(b'rebuilt')
+    with pytest.warns(UserWarning, match='source tree changed'):
+        assert ksks.find_cache('exp', 'p1', key, tree_path) is None
+    assert ksks.find_cache('exp', 'p1', key) == filename
+    os.remove(tree_path)
+    assert ksks.find_cache('exp', 'p1', key, tree_path) == filename
+
+def test_process_point_does_not_touch_source_trees(cache_dir, monkeypatch):
+    tree_path = '/store17/unreachable/tr_ph_exp.root'
+    ksks.write_cache(make_cut_kaons(), 'exp', 'p1', ksks.cache_key(tree_path), 'csv')
+    with open(ksks.counts_filename('exp', 'p1', tree_path), 'w') as f:
+        f.write('{"tree": "%s", "entries": 100, "finalstate_id": {"2": 100}}' % tree_path)
+    
+    touched = []
+    isfile = os.path.isfile
+    monkeypatch.setattr(os.path, 'isfile', lambda path: touched.append(path) or isfile(path))
+    row = {'elabel': 'p1', 'emeas': 510., 'exp_tree': tree_path, 'mlt_raw': np.nan, '4pi_raw': np.nan, 'lum_exp': 1.}
+    df_4pic = pd.DataFrame({'ebeam': [500, 600], 'cs_vis': [1., 1.]})
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        d0 = ksks.process_point(row, df_4pic, print_log=False)
+    assert d0['real_events'] == 50
+    assert tree_path not in touched
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from conftest import FakeTree, write_tree
+from pylib.preprocess import Handler, HandlerKSKS, KSKSCutChain, KSKSCutScan
+
+def test_fused_read_skips_baskets_without_kaon_pairs(tmp_path):
+    path = write_tree(str(tmp_path / 'tr_ph.root'), n_baskets=6, kaon_baskets={0, 3})
+    plain, fused = HandlerKSKS(FakeTree(path)), HandlerKSKS(FakeTree(path), fused=True)
+    dat_plain, dat_fused = plain.get_good_kaons(), fused.get_good_kaons()
+    assert len(dat_plain) > 0
+    pd.testing.assert_frame_equal(dat_plain, dat_fused)
+    assert fused.read_stats['bytes_read'] < plain.read_stats['bytes_read']
+
+def test_chunked_recoil_uses_file_level_emeas(tmp_path):
+    path = write_tree(str(tmp_path / 'tr_ph.root'), n_baskets=2, emeas=lambda rng, n: rng.uniform(540, 560, n))
+    handler = Handler(FakeTree(path))
+    for photons in [None, 'one', 'all']:
+        dat = handler.get_good_kaons(photons)
+        dat_chunked = handler.get_good_kaons_chunked(700, photons)
+        assert dat['emeas'].nunique() > 1
+        pd.testing.assert_frame_equal(dat, dat_chunked)
+
+def test_chunked_reads_tree_once(tmp_path):
+    path = write_tree(str(tmp_path / 'tr_ph.root'), n_baskets=4, emeas=lambda rng, n: rng.uniform(540, 560, n))
+    def bytes_read(**kwargs):
+        tree = FakeTree(path)
+        bytes0 = tree.file.source.num_requested_bytes
+        Handler(tree).get_good_kaons_chunked(3000, **kwargs)
+        return tree.file.source.num_requested_bytes - bytes0
+    assert bytes_read() == bytes_read(emeas=550.)
+
+def make_kaons(n=20000, seed=3):
+    """Пары каонов с заметным разбросом emeas между событиями"""
+    rng = np.random.default_rng(seed)
+    e = np.repeat(rng.uniform(505, 520, n), 2)
+    th, phi = rng.uniform(0.5, 2.6, n), rng.uniform(0, 2*np.pi, n)
+    df = pd.DataFrame({
+        'ksth': np.column_stack([th, np.pi - th + rng.normal(0, 0.2, n)]).ravel(),
+        'ksphi': np.column_stack([phi, phi + np.pi + rng.normal(0, 0.1, n)]).ravel(),
+        'ksminv': rng.normal(497.6, 20, 2*n), 'ksptot': np.sqrt(e**2 - 497.6**2) + rng.normal(0, 40, 2*n),
+        'kslen': rng.exponential(0.3, 2*n), 'emeas': e, 'finalstate_id': rng.integers(0, 4, 2*n)},
+        index=pd.MultiIndex.from_arrays([np.repeat(np.arange(n), 2), np.tile([0, 1], n)], names=['entry', 'subentry']))
+    return df[rng.uniform(size=2*n) > 0.03]
+
+def test_cut_chain_matches_handler_cuts():
+    df = make_kaons()
+    d = HandlerKSKS.collinear_cut(df, 0.25, 0.15)
+    d = HandlerKSKS.sum_energy_cut(d, cut_en=100)
+    d = HandlerKSKS.kaon_mom_cut(d, cut_mom=60)
+    d = HandlerKSKS.flight_cut(d, cut_flight=0.1)
+    d = HandlerKSKS.ksminv_cut(d, cut_mass=25)
+    pd.testing.assert_frame_equal(d, KSKSCutChain().apply(df)[0])
+
+def test_cut_scan_matches_chain():
+    df = make_kaons()
+    scan = KSKSCutScan(df, signal='finalstate_id==2')
+    grid = dict(col_th=[0.1, 0.25, 0.5], col_phi=[0.05, 0.15, 0.4], cut_en=[20, 50, 100], cut_mom=[10, 30, 60],
+                cut_flight=[0.0, 0.1, 0.3], cut_mass=[10, 25, 50])
+    counts = scan.counts(grid)
+    signal = df.eval('finalstate_id==2').groupby(level=0).any()
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        combo = {t: rng.choice(values) for t, values in grid.items()}
+        dat, cutflow = KSKSCutChain(**combo, emeas=scan.emeas).apply(df)
+        entries = dat.index.get_level_values(0).unique()
+        row = counts.loc[tuple(combo[t] for t in counts.index.names)]
+        assert row['events'] == len(entries) == cutflow['events'].iloc[-1]
+        assert row['signal'] == signal.loc[entries].sum()
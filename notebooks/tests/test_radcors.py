@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from pylib.radcors import RadCor
+
+def test_radiator_table_checks_energies_and_metadata(tmp_path):
+    grid = np.linspace(497.6, 1000, 50)
+    radcor = RadCor(grid, np.ones_like(grid))
+    radcor.build_table([550., 600., 700.])
+    params = [0.02, 0.004, 0.004, 0.35]
+    
+    exact = radcor.F_Radcor_batch([550., 700.], params, method='table')
+    close = radcor.F_Radcor_batch([550., 700. + 1e-9], params, method='table')
+    np.testing.assert_allclose(exact.values, close.values)
+    for e_beam in [650., 400., 2000., np.nan]:
+        with pytest.raises(ValueError, match='not in the radiator table'):
+            radcor.F_Radcor_batch([e_beam], params, method='table')
+    with pytest.raises(ValueError, match='Xmax'):
+        radcor.F_Radcor_batch([550.], params, method='table', Xmax=0.5)
+    
+    filename = str(tmp_path / 'table.npz')
+    radcor.save_table(filename)
+    loaded = RadCor(grid, np.ones_like(grid))
+    loaded.load_table(filename, Xmax=1, de=0.5)
+    np.testing.assert_allclose(loaded.F_Radcor_batch([600.], params, method='table').values, 
+                               radcor.F_Radcor_batch([600.], params, method='table').values)
+    with pytest.raises(ValueError, match='de'):
+        loaded.load_table(filename, de=0.25)
+
+def test_radcor_batch_requires_efficiency_parameters():
+    grid = np.linspace(497.6, 1000, 50)
+    radcor = RadCor(grid, np.ones_like(grid))
+    with pytest.raises(ValueError, match='Efficiency parameters'):
+        radcor.F_Radcor_batch([510., 600.])
+    rad = radcor.F_Radcor_batch([510., 600.], use_efficiency=False)
+    assert np.isfinite(rad.values).all()
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from pylib.regeff import RegEff, FIT_COLUMNS
+
+def make_regeff(energies=(510., 550., 600., 700.), seed=2):
+    rng = np.random.default_rng(seed)
+    regeff = RegEff(None, None)
+    regeff.full_values, parts = {}, []
+    for e in energies:
+        full = rng.uniform(0, 0.1, 30000).astype(np.float32)
+        selected = full[rng.uniform(size=full.size) < RegEff.sigFunc(full, 0.02, 0.004, 0.004, 0.35)]
+        regeff.full_values[e] = full
+        parts.append(pd.DataFrame({'sim_energy': selected}, index=np.full(selected.size, e)))
+    regeff.df = pd.concat(parts).sort_index()
+    regeff.uniques = regeff.df.index.unique()
+    return regeff
+
+def test_fit_results_contain_only_fitted_energies():
+    regeff = make_regeff()
+    assert regeff.fit_results is None
+    regeff.fit(3, plot=False)
+    regeff.fit(1, plot=False)
+    results = regeff.fit_results
+    assert list(results.index) == [550., 700.] and list(results.columns) == FIT_COLUMNS
+    assert not results.isna().any().any()
+    
+    regeff.fit(1, plot=False, mu0=0.03)
+    assert len(regeff.fit_results) == 2
+    regeff.fit_global()
+    assert list(regeff.fit_results.index) == list(regeff.uniques)
@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+
+from pylib.preprocess_data.utils import cut_two_body_decay_angle, cut_two_body_decay_angle_batch
+
+def test_decay_angle_batch_rejects_nan_band_edges():
+    rng = np.random.default_rng(0)
+    n = 2000
+    tptot, ksdpsi = rng.uniform(100, 450, n), rng.uniform(0, np.pi, n)
+    low, high = np.full(n, 540.), np.full(n, 560.)
+    low[::3], high[1::5] = np.nan, np.nan
+    valid = ~np.isnan(low) & ~np.isnan(high)
+    
+    mask = cut_two_body_decay_angle_batch(tptot, ksdpsi, (low, high))
+    assert not mask[~valid].any()
+    assert (mask[valid] == cut_two_body_decay_angle(tptot[valid], ksdpsi[valid], (540., 560.))).all()
+    assert mask[valid].any()
+    
+    mask = cut_two_body_decay_angle_batch(pd.Series(tptot), pd.Series(ksdpsi), (np.full(n, np.nan), high))
+    assert isinstance(mask, pd.Series) and not mask.any()